@@ -0,0 +1,240 @@
+"""
+Offline mode using the OpenAI Batch API: every page of one or more pset folders goes into
+a single jsonl file which is submitted as one batch job (about half the price, and no per
+request rate limits). Once the batch finishes, the results are fed through the normal
+save_response_as_tex/compile_latex path, with the pages compiled in parallel.
+
+    python3 batch_mode.py submit --homework 3 folder_a folder_b
+    python3 batch_mode.py ingest --homework 3 batch_abc123
+"""
+import json
+import time
+import argparse
+import requests
+import gpt4_to_tex
+import job_manifest
+import document_input
+import tracing
+
+POLL_INTERVAL_SECONDS = 30
+BATCH_REQUESTS_FILE = gpt4_to_tex.RESULTS_FOLDER / "batch_requests.jsonl"
+
+
+def make_custom_id(folder, page_number, image_name):
+    return json.dumps([str(folder), page_number, image_name])
+
+
+def parse_custom_id(custom_id):
+    folder, page_number, image_name = json.loads(custom_id)
+    return folder, page_number, image_name
+
+
+def write_request(batch_file, folder, page_number, image_name, latex_preamble, base64_image):
+    payload = gpt4_to_tex.build_payload(latex_preamble, base64_image, "single_image")
+    request_line = {
+        "custom_id": make_custom_id(folder, page_number, image_name),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": payload,
+    }
+    batch_file.write(json.dumps(request_line) + "\n")
+
+
+def build_batch_file(folders, homework_number, batch_path=BATCH_REQUESTS_FILE):
+    """
+    Write one chat completions request per unfinished page of every folder, the pages of
+    its scanned documents included. Pages are encoded and written one at a time, so only
+    one image is held in memory.
+    """
+    num_requests = 0
+    batch_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(batch_path, "w") as batch_file:
+        for folder in folders:
+            manifest = job_manifest.manifest_for(gpt4_to_tex.RESULTS_FOLDER / folder)
+            for idx, image_name in enumerate(gpt4_to_tex.list_page_images(folder)):
+                page_number = idx + 1
+                image_path = gpt4_to_tex.PSET_FOLDER / folder / image_name
+                if manifest.is_done(image_name, image_path):
+                    continue
+                latex_preamble = gpt4_to_tex.get_latex_preamble(
+                    page_number, homework_number
+                )
+                write_request(
+                    batch_file,
+                    folder,
+                    page_number,
+                    image_name,
+                    latex_preamble,
+                    gpt4_to_tex.encode_image(image_path),
+                )
+                manifest.mark(image_name, "encoded", image_path)
+                num_requests += 1
+            pages = gpt4_to_tex.list_document_pages(folder)
+            for document_path in dict.fromkeys(page[0] for page in pages):
+                document_hash = job_manifest.hash_image_file(document_path)
+                todo = {
+                    page_in_document: (page_number, name)
+                    for path, page_in_document, page_number, name in pages
+                    if path == document_path
+                    and not manifest.is_done(name, image_hash=document_hash)
+                }
+                for page_in_document, img in document_input.iter_readable_pages(
+                    document_path, page_numbers=list(todo)
+                ):
+                    page_number, name = todo[page_in_document]
+                    write_request(
+                        batch_file,
+                        folder,
+                        page_number,
+                        name,
+                        gpt4_to_tex.get_latex_preamble(page_number, homework_number),
+                        gpt4_to_tex.encode_page_image(img, name),
+                    )
+                    manifest.mark(name, "encoded", image_hash=document_hash)
+                    num_requests += 1
+    print(f"wrote {num_requests} requests to {batch_path}")
+    return num_requests
+
+
+def submit_batch(api_key, batch_path=BATCH_REQUESTS_FILE):
+    """Upload the jsonl file and start a batch job on it. Returns the batch id."""
+    headers = {"Authorization": f"Bearer {api_key}"}
+    with open(batch_path, "rb") as batch_file:
+        response = requests.post(
+            f"{gpt4_to_tex.API_BASE_URL}/files",
+            headers=headers,
+            data={"purpose": "batch"},
+            files={"file": (batch_path.name, batch_file)},
+        )
+    response.raise_for_status()
+    input_file_id = response.json()["id"]
+
+    response = requests.post(
+        f"{gpt4_to_tex.API_BASE_URL}/batches",
+        headers=headers,
+        json={
+            "input_file_id": input_file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+        },
+    )
+    response.raise_for_status()
+    batch_id = response.json()["id"]
+    print(f"submitted batch {batch_id}")
+    return batch_id
+
+
+def wait_for_batch(api_key, batch_id, poll_interval=POLL_INTERVAL_SECONDS):
+    """Poll the batch until it stops running, and return its final status object."""
+    headers = {"Authorization": f"Bearer {api_key}"}
+    while True:
+        response = requests.get(
+            f"{gpt4_to_tex.API_BASE_URL}/batches/{batch_id}", headers=headers
+        )
+        response.raise_for_status()
+        batch = response.json()
+        if batch["status"] in ("completed", "failed", "expired", "cancelled"):
+            return batch
+        counts = batch.get("request_counts", {})
+        print(
+            f"batch {batch_id} is {batch['status']} "
+            f"({counts.get('completed', 0)}/{counts.get('total', '?')} done)"
+        )
+        time.sleep(poll_interval)
+
+
+def download_file_lines(api_key, file_id):
+    headers = {"Authorization": f"Bearer {api_key}"}
+    response = requests.get(
+        f"{gpt4_to_tex.API_BASE_URL}/files/{file_id}/content",
+        headers=headers,
+        stream=True,
+    )
+    response.raise_for_status()
+    for line in response.iter_lines():
+        if line:
+            yield json.loads(line)
+
+
+def ingest_batch_results(api_key, batch, homework_number):
+    """
+    Save every page of a finished batch, then compile them all in parallel. Returns the
+    folders that were in the batch and the (folder, image_name) of every page that failed.
+    """
+    folders = set()
+    failed = []
+    saved = []
+    if batch.get("output_file_id"):
+        for result in download_file_lines(api_key, batch["output_file_id"]):
+            folder, page_number, image_name = parse_custom_id(result["custom_id"])
+            folders.add(folder)
+            (gpt4_to_tex.RESULTS_FOLDER / folder).mkdir(parents=True, exist_ok=True)
+            manifest = job_manifest.manifest_for(gpt4_to_tex.RESULTS_FOLDER / folder)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                print(f"batch request for {folder}/{image_name} got {response}")
+                failed.append((folder, image_name))
+                continue
+            manifest.mark(image_name, "response_received")
+            tex_path = gpt4_to_tex.tex_path_for(folder, image_name)
+            saved_status = gpt4_to_tex.save_response_as_tex(
+                response["body"],
+                gpt4_to_tex.get_latex_preamble(page_number, homework_number),
+                tex_path,
+            )
+            if saved_status != "success":
+                failed.append((folder, image_name))
+                continue
+            manifest.mark(image_name, "tex_written")
+            saved.append((folder, image_name, tex_path))
+
+    compiled = gpt4_to_tex.compile_many_latex([tex_path for _, _, tex_path in saved])
+    for (folder, image_name, _), success in zip(saved, compiled):
+        if success:
+            job_manifest.manifest_for(gpt4_to_tex.RESULTS_FOLDER / folder).mark(
+                image_name, "compiled"
+            )
+        else:
+            failed.append((folder, image_name))
+
+    if batch.get("error_file_id"):
+        for result in download_file_lines(api_key, batch["error_file_id"]):
+            folder, _, image_name = parse_custom_id(result["custom_id"])
+            print(f"batch request for {folder}/{image_name} failed: {result.get('error')}")
+            failed.append((folder, image_name))
+    print(f"ingested batch {batch['id']}, {len(failed)} pages failed")
+    return folders, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run pset folders through the batch api.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    submit_parser = subparsers.add_parser("submit", help="build and submit a batch")
+    submit_parser.add_argument("--homework", type=int, required=True)
+    submit_parser.add_argument("folders", nargs="+")
+    ingest_parser = subparsers.add_parser("ingest", help="wait for and ingest a batch")
+    ingest_parser.add_argument("--homework", type=int, required=True)
+    ingest_parser.add_argument("batch_id")
+    args = parser.parse_args()
+
+    api_key = gpt4_to_tex.load_parameters()["openai_api_key"]
+    tracing.start_trace(gpt4_to_tex.RESULTS_FOLDER / gpt4_to_tex.TRACE_FILE_NAME)
+    if args.command == "submit":
+        if build_batch_file(args.folders, args.homework) == 0:
+            print("nothing to submit")
+            return
+        print(submit_batch(api_key))
+    else:
+        batch = wait_for_batch(api_key, args.batch_id)
+        folders, failed = ingest_batch_results(api_key, batch, args.homework)
+        for folder, image_name in failed:
+            print(f"failed: {folder}/{image_name}")
+        for folder in sorted(folders):
+            gpt4_to_tex.consolidate_tex_files_sorted(
+                gpt4_to_tex.RESULTS_FOLDER / folder, args.homework
+            )
+    tracing.print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+End to end throughput benchmark: runs process_images_concurrently and
+consolidate_tex_files_sorted over synthetic pset folders against mock_openai_server.py,
+and reports pages/sec, p50/p95 latency per page and bytes uploaded.
+
+    python3 benchmark.py --pages 1 10 100 500 --latency 2 --rate-limit-rate 0.05
+
+Needs pdflatex, like the normal pipeline. Nothing outside the temporary folder is touched.
+
+    python3 benchmark.py --startup
+
+instead times importing gpt4_to_tex in fresh interpreters, and fails if it takes longer
+than STARTUP_BUDGET_SECONDS or pulls in matplotlib, PIL or requests.
+
+    python3 benchmark.py --memory
+
+measures the memory one page takes while it is encoded and while its request body is
+built and sent, and fails if sending costs more than BODY_OVERHEAD_BUDGET_BYTES on top
+of the page's image.
+"""
+import sys
+import json
+import time
+import random
+import shutil
+import statistics
+import subprocess
+import argparse
+import tempfile
+import tracemalloc
+import threading
+from pathlib import Path
+import gpt4_to_tex
+import mock_openai_server
+import request_body
+import tracing
+
+# these should only be imported when the code that needs them runs
+HEAVY_MODULES = ("matplotlib", "PIL", "requests", "numpy")
+STARTUP_BUDGET_SECONDS = 0.5
+# what building and streaming a request body may add to the image it carries
+BODY_OVERHEAD_BUDGET_BYTES = 4 * request_body.BODY_CHUNK_BYTES
+
+
+def measure_import_time(module="gpt4_to_tex", runs=5):
+    """
+    Import module in runs fresh interpreters. Returns the import times in seconds and the
+    heavy modules that the import loaded.
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    times = []
+    loaded = set()
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        seconds, heavy = result.stdout.split("\n")[:2]
+        times.append(float(seconds))
+        loaded.update(heavy.split())
+    return times, sorted(loaded)
+
+
+def run_startup_benchmark(module="gpt4_to_tex", runs=5):
+    """Print the import time of module. Returns False if it is over budget or loads too much."""
+    times, loaded = measure_import_time(module, runs)
+    print(
+        f"import {module}: best {min(times):.3f}s, median {statistics.median(times):.3f}s "
+        f"over {runs} runs (budget {STARTUP_BUDGET_SECONDS}s)"
+    )
+    if loaded:
+        print(f"importing {module} loaded {', '.join(loaded)}")
+    return not loaded and min(times) <= STARTUP_BUDGET_SECONDS
+
+
+def measure_page_memory(image_path):
+    """
+    Peak memory of one page, from tracemalloc, so python objects only (PIL's pixel
+    buffers aren't counted, there is one decode of the page at a time). Returns the size
+    of the page's data url, the peak while encoding it, and what building and reading its
+    request body added on top of the data url, streamed and with json.dumps.
+    """
+    tracemalloc.start()
+    try:
+        base64_image = gpt4_to_tex.encode_image(image_path)
+        _, encode_peak = tracemalloc.get_traced_memory()
+
+        tracemalloc.reset_peak()
+        held, _ = tracemalloc.get_traced_memory()
+        payload = gpt4_to_tex.build_payload("", base64_image, "single_image")
+        body = request_body.StreamedJSONBody(payload)
+        while body.read(request_body.BODY_CHUNK_BYTES):
+            pass
+        del payload, body
+        _, streamed_peak = tracemalloc.get_traced_memory()
+
+        tracemalloc.reset_peak()
+        held, _ = tracemalloc.get_traced_memory()
+        payload = gpt4_to_tex.build_payload("", base64_image, "single_image")
+        body = json.dumps(payload).encode()
+        del payload, body
+        _, dumps_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "data_url": len(base64_image),
+        "encode_peak": encode_peak,
+        "streamed_body": streamed_peak - held,
+        "dumps_body": dumps_peak - held,
+    }
+
+
+def run_memory_benchmark(sizes=((1500, 2000), (3000, 4000))):
+    """Print the memory a page takes at a few photo sizes. Returns False if over budget."""
+    ok = True
+    with tempfile.TemporaryDirectory(prefix="pset_benchmark_") as work_folder:
+        for size in sizes:
+            image_path = Path(work_folder) / f"page_{size[0]}x{size[1]}.jpeg"
+            make_synthetic_page(image_path, 1, size)
+            result = measure_page_memory(image_path)
+            print(
+                f"{size[0]}x{size[1]} photo: {result['data_url'] / 1e3:.0f} kB data url, "
+                f"{result['encode_peak'] / 1e3:.0f} kB peak while encoding, "
+                f"+{result['streamed_body'] / 1e3:.0f} kB to send it "
+                f"(+{result['dumps_body'] / 1e3:.0f} kB with json.dumps)"
+            )
+            ok = ok and result["streamed_body"] <= BODY_OVERHEAD_BUDGET_BYTES
+    print(f"budget for sending: +{BODY_OVERHEAD_BUDGET_BYTES / 1e3:.0f} kB per page")
+    return ok
+
+
+def make_synthetic_page(image_path, page_number, size=(1500, 2000)):
+    """A white page of scribbled 'handwriting' lines, different for every page."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(page_number)
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    draw.text((60, 40), f"page {page_number}", fill="black")
+    for y in range(120, size[1] - 80, 70):
+        x = 60
+        while x < size[0] - 120:
+            word_width = rng.randint(30, 160)
+            points = [
+                (x + step, y + rng.randint(-12, 12)) for step in range(0, word_width, 6)
+            ]
+            draw.line(points, fill="black", width=3)
+            x += word_width + rng.randint(20, 50)
+    img.save(image_path, format="JPEG", quality=90)
+
+
+def make_synthetic_folder(pset_folder, name, num_pages, template_folder):
+    """Fill pset_folder/name with num_pages pages, generating only the ones not made yet."""
+    folder = pset_folder / name
+    folder.mkdir(parents=True, exist_ok=True)
+    template_folder.mkdir(parents=True, exist_ok=True)
+    for idx in range(num_pages):
+        # names match list_page_images, with the six digit time giving the page order
+        image_name = f"signal-2024-01-01-{100000 + idx:06d}.jpeg"
+        template_path = template_folder / image_name
+        if not template_path.exists():
+            make_synthetic_page(template_path, idx + 1)
+        shutil.copy(template_path, folder / image_name)
+    return Path(name)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, max(0, round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_benchmark(num_pages, work_folder, server, concurrency, pages_per_request=1):
+    """Run one synthetic folder through the pipeline and return its measurements."""
+    selected_folder = make_synthetic_folder(
+        gpt4_to_tex.PSET_FOLDER, f"bench_{num_pages}", num_pages, work_folder / "pages"
+    )
+    (gpt4_to_tex.RESULTS_FOLDER / selected_folder).mkdir(parents=True, exist_ok=True)
+    tracing.start_trace(
+        gpt4_to_tex.RESULTS_FOLDER / selected_folder / gpt4_to_tex.TRACE_FILE_NAME
+    )
+
+    # time each page from its first request to its successful compile
+    started = {}
+    finished = {}
+    lock = threading.Lock()
+    original_request_page = gpt4_to_tex.request_page
+    original_request_pack = gpt4_to_tex.request_pack
+    original_handle_response = gpt4_to_tex.handle_response
+
+    def timed_request_page(page_number, image_name, *args, **kwargs):
+        with lock:
+            started.setdefault(image_name, time.perf_counter())
+        return original_request_page(page_number, image_name, *args, **kwargs)
+
+    def timed_request_pack(pack, *args, **kwargs):
+        with lock:
+            for _, image_name in pack:
+                started.setdefault(image_name, time.perf_counter())
+        return original_request_pack(pack, *args, **kwargs)
+
+    def timed_handle_response(response_data, image_name, *args, **kwargs):
+        next_action = original_handle_response(response_data, image_name, *args, **kwargs)
+        if next_action == "continue":
+            finished[image_name] = time.perf_counter()
+        return next_action
+
+    with server.lock:
+        stats_before = dict(server.stats)
+    gpt4_to_tex.request_page = timed_request_page
+    gpt4_to_tex.request_pack = timed_request_pack
+    gpt4_to_tex.handle_response = timed_handle_response
+    start = time.perf_counter()
+    try:
+        failed = gpt4_to_tex.process_images_concurrently(
+            selected_folder,
+            "mock-key",
+            1,
+            max_workers=concurrency,
+            pages_per_request=pages_per_request,
+        )
+        gpt4_to_tex.consolidate_tex_files_sorted(
+            gpt4_to_tex.RESULTS_FOLDER / selected_folder, 1
+        )
+    finally:
+        gpt4_to_tex.request_page = original_request_page
+        gpt4_to_tex.request_pack = original_request_pack
+        gpt4_to_tex.handle_response = original_handle_response
+    elapsed = time.perf_counter() - start
+    tracing.print_summary()
+    with server.lock:
+        stats = {key: server.stats[key] - stats_before[key] for key in server.stats}
+
+    latencies = [finished[name] - started[name] for name in finished]
+    return {
+        "pages": num_pages,
+        "seconds": elapsed,
+        "pages_per_second": num_pages / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "megabytes_uploaded": stats["bytes_received"] / 1e6,
+        "requests": stats["requests"],
+        "rate_limited": stats["rate_limited"],
+        "errors": stats["errors"],
+        "failed": len(failed),
+    }
+
+
+def print_results(results):
+    print("")
+    print(
+        f"{'pages':>6} {'seconds':>8} {'pages/s':>8} {'p50 s':>7} {'p95 s':>7} "
+        f"{'MB up':>7} {'requests':>8} {'429s':>5} {'500s':>5} {'failed':>6}"
+    )
+    for result in results:
+        print(
+            f"{result['pages']:>6} {result['seconds']:>8.1f} "
+            f"{result['pages_per_second']:>8.2f} {result['p50']:>7.2f} "
+            f"{result['p95']:>7.2f} {result['megabytes_uploaded']:>7.1f} "
+            f"{result['requests']:>8} {result['rate_limited']:>5} "
+            f"{result['errors']:>5} {result['failed']:>6}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end pipeline benchmark.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--concurrency", type=int, default=gpt4_to_tex.MAX_CONCURRENT_REQUESTS)
+    parser.add_argument("--latency", type=float, default=1.0, help="mean api seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--pages-per-request", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the work folder")
+    parser.add_argument(
+        "--startup", action="store_true", help="only time importing gpt4_to_tex"
+    )
+    parser.add_argument(
+        "--memory", action="store_true", help="only measure the memory of one page"
+    )
+    args = parser.parse_args()
+    if args.startup:
+        sys.exit(0 if run_startup_benchmark() else 1)
+    if args.memory:
+        sys.exit(0 if run_memory_benchmark() else 1)
+
+    server, base_url = mock_openai_server.start_in_background(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=0.5,
+    )
+    work_folder = Path(tempfile.mkdtemp(prefix="pset_benchmark_"))
+    gpt4_to_tex.API_BASE_URL = base_url
+    gpt4_to_tex.PSET_FOLDER = work_folder / "psets"
+    gpt4_to_tex.RESULTS_FOLDER = work_folder / "results"
+    # every run has to go to the server, and nothing may wait for a person
+    gpt4_to_tex.USE_RESPONSE_CACHE = False
+    gpt4_to_tex.SHOW_COMPILED_PDF = False
+    gpt4_to_tex.SHOW_PAGE_IMAGE = False
+    gpt4_to_tex.PRINT_TEXT_PROMPT = False
+
+    try:
+        results = [
+            run_benchmark(
+                num_pages,
+                work_folder,
+                server,
+                args.concurrency,
+                args.pages_per_request,
+            )
+            for num_pages in args.pages
+        ]
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"work folder kept at {work_folder}")
+        else:
+            shutil.rmtree(work_folder)
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
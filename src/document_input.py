@@ -0,0 +1,168 @@
+"""
+Scanned documents (multi-page PDFs and TIFFs) as input. Their pages are rasterized one at
+a time at TARGET_DPI by a generator, so a long scan never has to fit in memory and no
+page images are written to disk. PDFs are rendered with PyMuPDF if it is installed, and
+otherwise with poppler's pdftoppm.
+"""
+import io
+import re
+import subprocess
+from pathlib import Path
+import file_index
+
+# PIL and PyMuPDF are imported inside the functions, like in gpt4_to_tex
+
+DOCUMENT_EXTENSIONS = (".pdf", ".tif", ".tiff")
+TARGET_DPI = 200  # plenty for handwriting, and close to MAX_LONG_EDGE for a letter page
+# the results of a document page are named output_<document>-<pdf|tif|tiff>-page-NNNN.tex
+DOCUMENT_TEX_PATTERN = re.compile(r"^output_(.+)-(pdf|tiff?)-page-(\d{4})\.tex$")
+# what reading a document fails with: no renderer installed (FileNotFoundError), a renderer
+# that gave up, or a file that isn't a document it understands (OSError from PIL,
+# RuntimeError from PyMuPDF)
+DOCUMENT_ERRORS = (OSError, subprocess.CalledProcessError, ValueError, RuntimeError)
+
+_skipped = set()
+
+
+def list_documents(folder):
+    """The scanned documents in a folder, by name."""
+    return [
+        name
+        for name in file_index.file_names(folder)
+        if Path(name).suffix.lower() in DOCUMENT_EXTENSIONS
+    ]
+
+
+def page_name(document_path, page_number):
+    """The name a document page goes by in the manifest and its output_*.tex file."""
+    document_path = Path(document_path)
+    # no dots, so that the name has no extension to strip
+    stem = document_path.stem.replace(".", "_")
+    return f"{stem}-{document_path.suffix[1:].lower()}-page-{page_number:04d}"
+
+
+def page_count(document_path):
+    document_path = Path(document_path)
+    if document_path.suffix.lower() != ".pdf":
+        from PIL import Image
+
+        with Image.open(document_path) as img:
+            return getattr(img, "n_frames", 1)
+    try:
+        import fitz
+    except ImportError:
+        fitz = None
+    if fitz is not None:
+        with fitz.open(document_path) as document:
+            return document.page_count
+    info = subprocess.run(
+        ["pdfinfo", str(document_path)], capture_output=True, text=True, check=True
+    ).stdout
+    match = re.search(r"^Pages:\s+(\d+)", info, re.M)
+    if match is None:
+        raise ValueError("pdfinfo didn't report a page count")
+    return int(match.group(1))
+
+
+def warn_unreadable(document_path, error):
+    """Say (once per document) that a document is left out, and why."""
+    if str(document_path) in _skipped:
+        return
+    _skipped.add(str(document_path))
+    print(f"skipping {Path(document_path).name}, it can't be read: {error}")
+
+
+def readable_page_count(document_path):
+    """page_count, or 0 for a document that can't be read, which is then left out."""
+    try:
+        return page_count(document_path)
+    except DOCUMENT_ERRORS as error:
+        warn_unreadable(document_path, error)
+        return 0
+
+
+def iter_pdf_pages(pdf_path, dpi, page_numbers):
+    from PIL import Image
+
+    try:
+        import fitz
+    except ImportError:
+        fitz = None
+    if fitz is not None:
+        with fitz.open(pdf_path) as document:
+            for page_number in page_numbers:
+                pixmap = document[page_number - 1].get_pixmap(
+                    dpi=dpi, colorspace=fitz.csGRAY
+                )
+                yield page_number, Image.frombytes(
+                    "L",
+                    (pixmap.width, pixmap.height),
+                    pixmap.samples,
+                    "raw",
+                    "L",
+                    pixmap.stride,
+                )
+        return
+    for page_number in page_numbers:
+        # one page at a time, straight to a pipe rather than to an image file
+        result = subprocess.run(
+            [
+                "pdftoppm",
+                "-r",
+                str(dpi),
+                "-f",
+                str(page_number),
+                "-l",
+                str(page_number),
+                "-gray",
+                str(pdf_path),
+            ],
+            capture_output=True,
+            check=True,
+        )
+        img = Image.open(io.BytesIO(result.stdout))
+        img.load()
+        yield page_number, img
+
+
+def iter_tiff_pages(tiff_path, dpi, page_numbers):
+    from PIL import Image
+
+    with Image.open(tiff_path) as tiff:
+        for page_number in page_numbers:
+            tiff.seek(page_number - 1)
+            img = tiff.copy()
+            if img.mode in ("1", "P"):
+                # scanners like 1 bit pages, which resize badly
+                img = img.convert("L")
+            source_dpi = (tiff.info.get("dpi") or (dpi, dpi))[0]
+            if source_dpi and source_dpi > dpi:
+                scale = dpi / source_dpi
+                img = img.resize(
+                    (round(img.width * scale), round(img.height * scale)), Image.LANCZOS
+                )
+            yield page_number, img
+
+
+def iter_document_pages(document_path, dpi=None, page_numbers=None):
+    """
+    Yield (page number, PIL image) for the pages of a document in document order,
+    rasterizing each one only when it is asked for. page_numbers (counting from 1)
+    restricts it to those pages.
+    """
+    if dpi is None:
+        dpi = TARGET_DPI
+    if page_numbers is None:
+        page_numbers = range(1, page_count(document_path) + 1)
+    if Path(document_path).suffix.lower() == ".pdf":
+        yield from iter_pdf_pages(document_path, dpi, page_numbers)
+    else:
+        yield from iter_tiff_pages(document_path, dpi, page_numbers)
+
+
+def iter_readable_pages(document_path, dpi=None, page_numbers=None):
+    """iter_document_pages, but stopping with a warning if the document can't be read."""
+    try:
+        yield from iter_document_pages(document_path, dpi, page_numbers)
+    except DOCUMENT_ERRORS as error:
+        warn_unreadable(document_path, error)
@@ -0,0 +1,110 @@
+"""
+Cached listings of the pset and results folders. A folder is read with os.scandir and
+each page file name in it is parsed once into a (timestamp, sequence, ext) record, and
+the listing is reused until the folder's mtime changes (adding, removing or renaming a
+file changes it). The page photos and their output_*.tex files are put in order from the
+same records, so a folder of thousands of photos isn't listed and matched again every
+time the pages are counted, deduplicated, sent or consolidated.
+"""
+import os
+import re
+import time
+import threading
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# the photos of a page, e.g. signal-2024-05-07-123456.jpeg or signal-2024-05-07-123456_001.png
+PAGE_IMAGE_PATTERN = re.compile(
+    r"^signal-\d{4}-\d{2}-\d{2}-(\d{6})(?:_(\d{3}))?\.(?i:jpe?g|png)$"
+)
+# photos and the output_*.tex written for them, with the date and time in separate groups
+PAGE_FILE_PATTERN = re.compile(
+    r"^(output_)?signal-(\d{4})-(\d{2})-(\d{2})-(\d{6})(?:_(\d{3}))?(\.[A-Za-z]+)$"
+)
+# a folder whose mtime is this recent may still change without its mtime moving (on file
+# systems with coarse timestamps), so its listing isn't trusted yet
+RACY_SECONDS = 2.0
+
+# folder -> (mtime_ns, time it was scanned, FolderListing)
+_index = {}
+_lock = threading.Lock()
+
+
+class FolderListing:
+    """
+    The files of one folder, with its page photos and output_*.tex files in order. It is
+    shared by everyone asking about the folder, so the functions below return copies.
+    """
+
+    def __init__(self, names, records):
+        self.names = sorted(names)
+        self.records = records
+        self.images = self.sorted_pages(outputs=False)
+        self.tex_files = self.sorted_pages(outputs=True)
+
+    def sorted_pages(self, outputs):
+        pages = [
+            (record, name)
+            for name, (is_output, record) in self.records.items()
+            if is_output == outputs
+        ]
+        return [name for _, name in sorted(pages)]
+
+
+def parse_page_name(name):
+    """
+    Whether name is an output_*.tex file and its (timestamp, sequence, ext) record, or
+    None if it isn't a page file. The timestamp is YYYYMMDDHHMMSS, so pages taken on
+    different days stay in order, and pages without a _NNN sequence number count as 0.
+    """
+    match = PAGE_FILE_PATTERN.match(name)
+    if match is None:
+        return None
+    is_output, year, month, day, clock, sequence, ext = match.groups()
+    ext = ext.lower()
+    if is_output and ext != ".tex" or not is_output and ext not in IMAGE_EXTENSIONS:
+        return None
+    return bool(is_output), (int(year + month + day + clock), int(sequence or 0), ext)
+
+
+def folder_listing(folder):
+    """The FolderListing of folder, scanning it only if it changed since the last time."""
+    folder = os.fspath(folder)
+    mtime_ns = os.stat(folder).st_mtime_ns
+    with _lock:
+        cached = _index.get(folder)
+    if (
+        cached is not None
+        and cached[0] == mtime_ns
+        and cached[1] - mtime_ns / 1e9 > RACY_SECONDS
+    ):
+        return cached[2]
+    scanned_at = time.time()
+    names = []
+    records = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            names.append(entry.name)
+            parsed = parse_page_name(entry.name)
+            if parsed is not None:
+                records[entry.name] = parsed
+    listing = FolderListing(names, records)
+    with _lock:
+        _index[folder] = (mtime_ns, scanned_at, listing)
+    return listing
+
+
+def file_names(folder):
+    """The names of the files in folder, sorted."""
+    return list(folder_listing(folder).names)
+
+
+def page_images(folder):
+    """The page photos in folder (.jpg, .jpeg or .png) by time taken and sequence number."""
+    return list(folder_listing(folder).images)
+
+
+def page_tex_files(folder):
+    """The output_*.tex files of the photos in a results folder, in the same order."""
+    return list(folder_listing(folder).tex_files)
@@ -1,84 +1,250 @@
 import os
+import sys
+import argparse
 import subprocess
 import base64
-import requests
-from PIL import Image
 import json
+import hashlib
+import time
+import random
+import threading
+import traceback
+import collections
 from datetime import datetime
-import matplotlib
-import matplotlib.pyplot as plt
 from pathlib import Path
 import re
-import io
+import response_cache
+import job_manifest
+import image_preprocessing
+import latex_format
+import latex_compile
+import latex_validator
+import page_dedup
+import file_index
+import document_input
+import request_body
+import tracing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
 JUST_USE_DUMMY_DATA = False
 SHOW_COMPILED_PDF = True
 SHOW_PAGE_IMAGE = True
 PROCESS_BOTH_HALVES_THEN_PROCESS_WHOLE_PAGE = True
 PRINT_TEXT_PROMPT = True
+CONCURRENT_MODE = False  # send every page at once instead of asking about each one
+MAX_CONCURRENT_REQUESTS = 4
+MAX_ATTEMPTS_PER_PAGE = 3
+PAGES_PER_REQUEST = 1  # consecutive pages packed into one request in concurrent mode
+DEDUPLICATE_PAGES = True  # only send the sharpest of several photos of a page (see page_dedup.py)
+NUM_STRIPS = 2  # strips per page when processing in pieces, use 3-4 for long pages
+STRIP_OVERLAP = 0.2  # fraction of the page height shared by neighbouring strips
+PREPROCESS_IMAGES = True  # shrink photos before upload (see image_preprocessing.py)
+STREAM_RESPONSES = False  # stream the reply, stopping at \end{document}
+VALIDATE_LATEX = True  # reject obviously broken responses before running pdflatex
+USE_PRECOMPILED_PREAMBLE = True  # compile from a dumped .fmt of the preamble (see latex_format.py)
+USE_RESPONSE_CACHE = True  # reuse stored responses for identical requests (see response_cache.py)
+
+MODEL = "gpt-4-turbo"
+MAX_TOKENS = 1024  # per page
+MAX_OUTPUT_TOKENS = 4096  # the most the model writes in one reply, packed or not
+
+REQUEST_TIMEOUT_SECONDS = (10, 180)  # (connect, read)
+MAX_HTTP_RETRIES = 5  # per request, for rate limits, server errors and timeouts
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# a streamed reply without \section this many characters past the length of the latex
+# preamble (which the model may echo first) is abandoned and retried
+SECTION_DEADLINE_CHARS = 300
+# the line the model writes before each page of a packed request
+PAGE_MARKER_PATTERN = re.compile(r"^%+\s*PAGE\s+(\d+)\b.*$", re.M)
 
 JSON_PARAMETERS_LOCATION = "../data/params.json"
+# point this at mock_openai_server.py to run without the real api
+API_BASE_URL = "https://api.openai.com/v1"
+
+TRACE_FILE_NAME = "trace.jsonl"  # per stage timings, written to the results folder
 
 PSET_FOLDER = Path("../psets")
-RESULTS_FOLDER = Path("../results")
-RESULTS_FOLDER.mkdir(parents=True, exist_ok=True)
+# the photos of a page, e.g. signal-2024-05-07-123456.jpeg or signal-2024-05-07-123456_001.png
+PAGE_IMAGE_PATTERN = file_index.PAGE_IMAGE_PATTERN
+RESULTS_FOLDER = Path("../results")  # created by main, not on import
+DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+
+# requests, PIL and matplotlib are imported inside the functions that use them, since
+# importing them (matplotlib especially) dominates startup. See benchmark.py --startup.
+
+
+def image_data_url(image_bytes):
+    """
+    The data url of a JPEG, which is how the images go into the payload. The encoders
+    return these rather than the bare base64, so that building a payload doesn't make
+    a second copy of every image.
+    """
+    url = bytearray(DATA_URL_PREFIX)
+    url += base64.b64encode(image_bytes)
+    return url.decode("ascii")
 
 
 # Function to encode the image
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+def encode_image(image_path, img=None):
+    """
+    The page as a data url. img is the page already decoded by open_page_image, which
+    saves decoding it again when it is preprocessed.
+    """
+    with tracing.span(
+        "encode", page=Path(image_path).name, bytes_in=os.path.getsize(image_path)
+    ) as record:
+        if PREPROCESS_IMAGES and img is not None:
+            image_bytes = image_preprocessing.jpeg_bytes(img)
+            image_preprocessing.report_size(image_path, image_bytes)
+        elif PREPROCESS_IMAGES:
+            image_bytes = image_preprocessing.preprocess_file(image_path)
+        else:
+            with open(image_path, "rb") as image_file:
+                image_bytes = image_file.read()
+        base64_image = image_data_url(image_bytes)
+        record["bytes_out"] = len(base64_image)
+        return base64_image
 
 
-def encode_image_portion(image_path, start_pct, end_pct):
-    # Open the image
-    with Image.open(image_path) as img:
-        width, height = img.size
-        # Calculate the crop area
-        start_height = int(height * start_pct)
-        end_height = int(height * end_pct)
-        # Crop the image vertically
-        img_cropped = img.crop((0, start_height, width, end_height))
+def encode_page_image(img, page_name):
+    """Data url of a page that is already decoded, e.g. one rasterized from a scan."""
+    with tracing.span("encode", page=page_name) as record:
+        if PREPROCESS_IMAGES:
+            img = image_preprocessing.preprocess_image(img)
+        base64_image = image_data_url(image_preprocessing.jpeg_bytes(img))
+        record["bytes_out"] = len(base64_image)
+        return base64_image
 
-        # Save the cropped image to a bytes buffer
-        buffer = io.BytesIO()
-        img_cropped.save(
-            buffer, format="JPEG"
-        )  # You can change the format to match your specific needs
 
-        # Encode to base64
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+def crop_strips(img, bounds):
+    """
+    Cut full width strips (start and end as fractions of the height) out of a decoded page.
+    A grayscale page, which is what preprocessing gives, is copied into one pixel buffer
+    and the page and its strips are returned as views of it, so the strips cost no memory
+    of their own. Other modes are cropped the usual way. Returns the page and the strips.
+    """
+    from PIL import Image
+
+    width, height = img.size
+    rows = [(int(height * start_pct), int(height * end_pct)) for start_pct, end_pct in bounds]
+    if img.mode != "L":
+        return img, [img.crop((0, top, width, bottom)) for top, bottom in rows]
+    pixels = memoryview(img.tobytes())
+    page = Image.frombuffer("L", img.size, pixels, "raw", "L", 0, 1)
+    strips = [
+        Image.frombuffer(
+            "L", (width, bottom - top), pixels[top * width : bottom * width], "raw", "L", 0, 1
+        )
+        for top, bottom in rows
+    ]
+    return page, strips
 
 
-def encode_image_first_60pct(image_path):
-    return encode_image_portion(image_path, 0, 0.6)
+def open_page_image(image_path):
+    """Decode a page image (preprocessed if enabled) so it can be cropped several times."""
+    from PIL import Image
 
+    with Image.open(image_path) as original:
+        img = original
+        if PREPROCESS_IMAGES:
+            img = image_preprocessing.preprocess_image(original)
+        # leaving the with block frees the pixels of the opened image, so keep a copy
+        if img is original:
+            img = original.copy()
+        return img
 
-def encode_image_last_60pct(image_path):
-    return encode_image_portion(image_path, 0.4, 1.0)
 
+def strip_bounds(num_strips, overlap):
+    """
+    Start and end of each horizontal strip as fractions of the page height. Neighbouring
+    strips share `overlap` of the page, so 2 strips with 0.2 overlap are 0-60% and 40-100%.
+    """
+    strip_height = (1 + (num_strips - 1) * overlap) / num_strips
+    step = strip_height - overlap
+    bounds = [(i * step, i * step + strip_height) for i in range(num_strips)]
+    bounds[-1] = (bounds[-1][0], 1.0)
+    return bounds
 
-# Function to get the response from OpenAI API
-def get_response(
-    api_key,
-    latex_preamble,
-    base64_image,
-    prompt_type,
-    additional_context_before_latex_preamble="",
-):
+
+def encode_image_strips(image_path, num_strips, overlap, img=None):
+    """
+    Decode the page once (or use img, if the caller has decoded it already) and cut every
+    strip from that decode. Returns the strips and the whole page as data urls.
+    """
+    with tracing.span(
+        "decode_crop", page=Path(image_path).name, bytes_in=os.path.getsize(image_path)
+    ) as record:
+        if img is None:
+            img = open_page_image(image_path)
+        # from here on the decoded pixels are held once, by the page and its strip views
+        img, strips = crop_strips(img, strip_bounds(num_strips, overlap))
+        base64_strips = [
+            image_data_url(image_preprocessing.jpeg_bytes(strip)) for strip in strips
+        ]
+        del strips
+        record["bytes_out"] = sum(len(base64_strip) for base64_strip in base64_strips)
+    if PREPROCESS_IMAGES:
+        with tracing.span(
+            "encode", page=Path(image_path).name, bytes_in=os.path.getsize(image_path)
+        ) as record:
+            image_bytes = image_preprocessing.jpeg_bytes(img)
+            image_preprocessing.report_size(image_path, image_bytes)
+            base64_image = image_data_url(image_bytes)
+            record["bytes_out"] = len(base64_image)
+    else:
+        base64_image = encode_image(image_path)
+    return base64_strips, base64_image
+
+
+def get_system_prompt(prompt_type):
     if prompt_type == "single_image":
-        system_prompt = "Provide LaTeX completion which reproduces what is shown on the image in latex. Start your response with \\section and ending with \\end{document}. Be sure to use \\hbox to box answers that are boxed in the image. Do not converse with a nonexistent user. Do not offer corrections, only recreate what is written. Remember: you must start your response with \\section"
+        return "Provide LaTeX completion which reproduces what is shown on the image in latex. Start your response with \\section and ending with \\end{document}. Be sure to use \\hbox to box answers that are boxed in the image. Do not converse with a nonexistent user. Do not offer corrections, only recreate what is written. Remember: you must start your response with \\section"
     elif prompt_type == "piece_of_image":
-        system_prompt = "Provide LaTeX completion which reproduces what is shown on the image in latex. Start your response with \\section and ending with \\end{document}. Be sure to use \\hbox to box answers that are boxed in the image. Do not converse with a nonexistent user. Do not offer corrections, only recreate what is written. Do not render equations which are cut off at the top or bottom of the image. Remember: you must start your response with \\section"
+        return "Provide LaTeX completion which reproduces what is shown on the image in latex. Start your response with \\section and ending with \\end{document}. Be sure to use \\hbox to box answers that are boxed in the image. Do not converse with a nonexistent user. Do not offer corrections, only recreate what is written. Do not render equations which are cut off at the top or bottom of the image. Remember: you must start your response with \\section"
+    elif prompt_type == "multi_page":
+        return "Provide LaTeX completion which reproduces what is shown on each of the images in latex. The images are consecutive pages, transcribe each of them separately and in order. Before each page write a line containing only %%% PAGE n, where n counts the images from 1. Start each page with \\section and end each page with \\end{document}. Be sure to use \\hbox to box answers that are boxed in the image. Do not converse with a nonexistent user. Do not offer corrections, only recreate what is written. Remember: each page must start with its %%% PAGE line followed by \\section"
     elif prompt_type == "combined_image":
-        system_prompt = "Provide LaTeX completion which reproduces what is shown on the image in latex. Use provided context to improve the accuracy of your completion. Start your response with \\section and ending with \\end{document}. Be sure to use \\hbox to box answers that are boxed in the image. Do not converse with a nonexistent user. Do not offer corrections, only recreate what is written. Remember: you must start your response with \\section"
+        return "Provide LaTeX completion which reproduces what is shown on the image in latex. Use provided context to improve the accuracy of your completion. Start your response with \\section and ending with \\end{document}. Be sure to use \\hbox to box answers that are boxed in the image. Do not converse with a nonexistent user. Do not offer corrections, only recreate what is written. Remember: you must start your response with \\section"
     else:
         print("ERROR: prompt type not allowed")
         quit()
 
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
-    payload = {
-        "model": "gpt-4-turbo",
+
+def build_payload(
+    latex_preamble,
+    base64_image,
+    prompt_type,
+    additional_context_before_latex_preamble="",
+):
+    """
+    Build the chat completions request body for one image, or for a list of images (a
+    packed request, where each image is labelled with its page marker). The images are
+    data urls from the encoders, and go in as they are.
+    """
+    system_prompt = get_system_prompt(prompt_type)
+    if isinstance(base64_image, list):
+        image_content = []
+        for idx, base64_page in enumerate(base64_image):
+            image_content += [
+                {"type": "text", "text": f"%%% PAGE {idx + 1}"},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": base64_page},
+                },
+            ]
+        max_tokens = min(MAX_TOKENS * len(base64_image), MAX_OUTPUT_TOKENS)
+    else:
+        image_content = [
+            {
+                "type": "image_url",
+                "image_url": {"url": base64_image},
+            }
+        ]
+        max_tokens = MAX_TOKENS
+    return {
+        "model": MODEL,
         "messages": [
             {
                 "role": "system",
@@ -101,39 +267,288 @@ def get_response(
             },
             {
                 "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
-                    }
-                ],
+                "content": image_content,
             },
         ],
-        "max_tokens": 1024,
+        "max_tokens": max_tokens,
     }
 
+
+_session = None
+_session_lock = threading.Lock()
+_pool_size = 0  # connections the session keeps alive, raised by reserve_connections
+
+
+def mount_adapter(session, pool_size):
+    import requests
+
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def get_session():
+    """One keep-alive session shared by every request and thread."""
+    global _session, _pool_size
+    import requests
+
+    with _session_lock:
+        if _session is None:
+            _pool_size = max(10, MAX_CONCURRENT_REQUESTS * NUM_STRIPS, _pool_size)
+            _session = requests.Session()
+            mount_adapter(_session, _pool_size)
+        return _session
+
+
+def reserve_connections(count):
+    """
+    Make the session keep at least count connections alive, for runs with more requests
+    in flight than MAX_CONCURRENT_REQUESTS (e.g. --concurrency 16). Connections beyond
+    the pool size would be closed after every request.
+    """
+    global _pool_size
+    with _session_lock:
+        if count <= _pool_size:
+            return
+        _pool_size = count
+        if _session is not None:
+            mount_adapter(_session, _pool_size)
+
+
+def parse_duration(duration):
+    """Parse the rate limit reset headers, which look like "1s", "6m0s" or "20ms"."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", duration)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def retry_delay(response, attempt):
+    """
+    Seconds to wait before retrying. The server's Retry-After or rate limit reset headers
+    win if present, otherwise exponential backoff with jitter.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), BACKOFF_MAX_SECONDS)
+            except ValueError:
+                pass
+        if response.status_code == 429:
+            resets = [
+                parse_duration(response.headers.get(header, ""))
+                for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+            ]
+            resets = [reset for reset in resets if reset is not None]
+            if resets:
+                return min(max(resets), BACKOFF_MAX_SECONDS)
+    backoff = min(BACKOFF_BASE_SECONDS * 2**attempt, BACKOFF_MAX_SECONDS)
+    return backoff * random.uniform(0.5, 1)
+
+
+def post_with_retries(url, headers, payload, stream=False):
+    """POST on the shared session, retrying rate limits, server errors and timeouts."""
+    import requests
+
+    session = get_session()
+    for attempt in range(MAX_HTTP_RETRIES + 1):
+        response = None
+        try:
+            response = session.post(
+                url,
+                headers=headers,
+                # streamed rather than json=, which copies the whole body twice
+                data=request_body.StreamedJSONBody(payload),
+                timeout=REQUEST_TIMEOUT_SECONDS,
+                stream=stream,
+            )
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            print(f"got status {response.status_code} from the api")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print(f"request failed: {e}")
+        if attempt == MAX_HTTP_RETRIES:
+            break
+        tracing.count_retry()
+        delay = retry_delay(response, attempt)
+        print(f"retrying in {delay:.1f}s ({attempt + 1}/{MAX_HTTP_RETRIES})")
+        time.sleep(delay)
+    return response
+
+
+def read_streamed_response(response, num_documents=1, preamble_chars=0):
+    """
+    Read a streamed (server-sent events) completion, printing it as it arrives when on the
+    main thread. Stops reading at the num_documents-th \\end{document}, and gives up early
+    if no \\section shows up within SECTION_DEADLINE_CHARS after preamble_chars, or if the
+    stream breaks off. Returns response_data shaped like a non-streamed response, or None
+    if it gave up.
+    """
+    import requests
+
+    show_progress = threading.current_thread() is threading.main_thread()
+    deadline_chars = preamble_chars + SECTION_DEADLINE_CHARS
+    content = ""
+    finish_reason = None
+    usage = None
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices", []):
+                delta = choice.get("delta", {}).get("content") or ""
+                content += delta
+                finish_reason = choice.get("finish_reason") or finish_reason
+                if show_progress:
+                    print(delta, end="", flush=True)
+            if content.count("\\end{document}") >= num_documents:
+                # everything after this would be thrown away by get_continuation_text
+                finish_reason = "stop"
+                break
+            if "\\section" not in content and len(content) > deadline_chars:
+                print(
+                    f"\nno \\section in the first {deadline_chars} characters, giving up"
+                )
+                return None
+    except (requests.RequestException, ValueError) as error:
+        # a read timeout, a dropped connection or a malformed line after the headers came
+        # back, which post_with_retries can't see, so the page is tried again instead
+        print(f"\nthe streamed response broke off: {error}")
+        tracing.count_retry()
+        return None
+    finally:
+        response.close()
+    if show_progress:
+        print("")
+    return {
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }
+        ],
+        "usage": usage,
+    }
+
+
+# Function to get the response from OpenAI API
+def get_response(
+    api_key,
+    latex_preamble,
+    base64_image,
+    prompt_type,
+    additional_context_before_latex_preamble="",
+    use_cache=True,
+):
+    """
+    use_cache=False skips the cached answer (for deliberate resubmits). Responses aren't
+    cached here but by remember_response, once they have compiled, so response_data
+    carries its cache key. base64_image can be a list of pages, see request_pack.
+    """
+    base64_images = base64_image if isinstance(base64_image, list) else [base64_image]
+    system_prompt = get_system_prompt(prompt_type)
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+    payload = build_payload(
+        latex_preamble,
+        base64_image,
+        prompt_type,
+        additional_context_before_latex_preamble,
+    )
+
     if PRINT_TEXT_PROMPT:
         print("")
         print("")
         print(f"SYSTEM:\n{system_prompt}\n\n")
         print(f"USER:\n{additional_context_before_latex_preamble}{latex_preamble}")
 
-    print("posting image to openai api...")
     if JUST_USE_DUMMY_DATA:
+        print("posting image to openai api...")
         return True, latex_preamble
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
-    )
-    if response.status_code == 200:
-        response_data = response.json()
-        if "choices" in response_data and len(response_data["choices"]) > 0:
-            # continued_latex = response_data["choices"][0]["message"]["content"]
+
+    key = response_cache.cache_key(prompt_type, payload)
+    if USE_RESPONSE_CACHE and use_cache:
+        with tracing.span("cache_lookup") as record:
+            response_data = response_cache.load_cached_response(key)
+            record["hit"] = response_data is not None
+        if response_data is not None:
+            print("using cached response")
+            response_data["cache"] = {"key": key, "hit": True}
             return response_data, latex_preamble
-        print("no choices in response data...")
+
+    print("posting image to openai api...")
+    if STREAM_RESPONSES:
+        # streaming doesn't change the answer, so it isn't part of the cache key
+        request_payload = dict(
+            payload, stream=True, stream_options={"include_usage": True}
+        )
     else:
-        print("error in response:")
-        print(response)
-    return None, None
+        request_payload = payload
+    with tracing.span(
+        "request", prompt_type=prompt_type, pages=len(base64_images)
+    ) as record:
+        # close enough to the body size without serializing the image a second time
+        record["bytes_out"] = (
+            sum(len(base64_page) for base64_page in base64_images)
+            + len(system_prompt)
+            + len(additional_context_before_latex_preamble)
+            + len(latex_preamble)
+        )
+        response = post_with_retries(
+            f"{API_BASE_URL}/chat/completions",
+            headers,
+            request_payload,
+            stream=STREAM_RESPONSES,
+        )
+        if response is None:
+            print("no response from the api")
+            return None, latex_preamble
+        if response.status_code != 200:
+            print("error in response:")
+            print(response)
+            return None, latex_preamble
+        if STREAM_RESPONSES:
+            response_data = read_streamed_response(
+                response, len(base64_images), len(latex_preamble)
+            )
+            if response_data is None:
+                return None, latex_preamble
+            record["bytes_in"] = len(response_data["choices"][0]["message"]["content"])
+        else:
+            record["bytes_in"] = len(response.content)
+            response_data = response.json()
+        tracing.record_usage(record, response_data)
+    if "choices" in response_data and len(response_data["choices"]) > 0:
+        # continued_latex = response_data["choices"][0]["message"]["content"]
+        if USE_RESPONSE_CACHE:
+            response_data["cache"] = {"key": key, "hit": False}
+        return response_data, latex_preamble
+    print("no choices in response data...")
+    return None, latex_preamble
+
+
+def remember_response(response_data, compiled):
+    """
+    Cache a fresh response once it has compiled, and drop a cached one that didn't, so
+    that a bad answer is never what the next run gets first.
+    """
+    if not isinstance(response_data, dict) or not response_data.get("cache"):
+        return
+    cache = response_data["cache"]
+    if compiled and not cache["hit"]:
+        response_cache.save_cached_response(
+            cache["key"],
+            {key: value for key, value in response_data.items() if key != "cache"},
+        )
+    elif not compiled and cache["hit"]:
+        response_cache.delete_cached_response(cache["key"])
 
 
 def get_continuation_text(response_data):
@@ -153,6 +568,23 @@ def get_continuation_text(response_data):
         return None
 
 
+def validate_response(response_data, latex_preamble):
+    """Problems in the response found without running pdflatex, empty if it looks fine."""
+    problems = []
+    if latex_validator.is_truncated(response_data):
+        problems.append(
+            {
+                "message": f"the response was cut off at max_tokens ({MAX_TOKENS})",
+                "line": None,
+                "context": "",
+            }
+        )
+    continuation = get_continuation_text(response_data)
+    if continuation is not None:
+        problems += latex_validator.validate_latex(latex_preamble + continuation)
+    return problems
+
+
 # Function to save the LaTeX response as a .tex file
 def save_response_as_tex(response_data, latex_preamble, tex_filename):
     if response_data:
@@ -161,7 +593,15 @@ def save_response_as_tex(response_data, latex_preamble, tex_filename):
         print("continued_latex")
         print(continuation)
         print("")
+        if latex_validator.is_truncated(response_data):
+            print("the response was cut off at max_tokens")
         if continuation is not None:
+            if VALIDATE_LATEX:
+                problems = validate_response(response_data, latex_preamble)
+                if problems:
+                    print("the latex is broken, not compiling it:")
+                    print(latex_compile.format_errors(problems))
+                    return "invalid_latex"
             final_text = latex_preamble + continuation
             print("opening at path")
             print(tex_filename)
@@ -175,14 +615,70 @@ def save_response_as_tex(response_data, latex_preamble, tex_filename):
     return "no_response"
 
 
+def fixed_preamble_lines():
+    """The class and package lines every page starts with, which go into the .fmt file."""
+    return [
+        line
+        for line in get_latex_preamble(page_number=2, homework_number=0).splitlines()
+        if line.startswith(("\\documentclass", "\\usepackage"))
+    ]
+
+
+def get_format_path(use_format=None):
+    if use_format is None:
+        use_format = USE_PRECOMPILED_PREAMBLE
+    if not use_format:
+        return None
+    return latex_format.ensure_format(fixed_preamble_lines(), RESULTS_FOLDER)
+
+
+def report_compile(tex_file, result, format_path):
+    if result["skipped"]:
+        print(f"{tex_file.name} is unchanged since it last compiled, skipping")
+    elif result["success"]:
+        print(
+            f"compiled {tex_file.name} in {result['seconds']:.2f}s"
+            + (" (precompiled preamble)" if format_path is not None else "")
+        )
+    else:
+        print(f"failed to compile {tex_file.name}:")
+        print(latex_compile.format_errors(result["errors"]))
+
+
 # Function to compile the LaTeX file
-def compile_latex(tex_file):
-    try:
-        subprocess.run(["pdflatex", tex_file.name], cwd=tex_file.parent, check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print("failed to compile latex")
-        return False
+def compile_latex(tex_file, use_format=None, force=False):
+    """Compile without stopping for input. Files unchanged since they last compiled are skipped."""
+    format_path = get_format_path(use_format)
+    with tracing.span("compile", bytes_in=os.path.getsize(tex_file)) as record:
+        result = latex_compile.compile_tex(tex_file, format_path, force=force)
+        if not result["success"] and format_path is not None:
+            # a broken or stale .fmt fails every compile, so try once without it
+            format_path = None
+            result = latex_compile.compile_tex(tex_file, force=force)
+        record["skipped"] = result["skipped"]
+        record["success"] = result["success"]
+    report_compile(tex_file, result, format_path)
+    return result["success"]
+
+
+def compile_many_latex(tex_files, use_format=None, force=False):
+    """Compile many files in parallel, returning whether each one compiled."""
+    format_path = get_format_path(use_format)
+    results = latex_compile.compile_many(tex_files, format_path, force=force)
+    failed = [idx for idx, result in enumerate(results) if not result["success"]]
+    if failed and format_path is not None:
+        # try the ones that failed once more without the format, in case it is what broke
+        retried = latex_compile.compile_many([tex_files[idx] for idx in failed], force=force)
+        for idx, result in zip(failed, retried):
+            results[idx] = result
+    for idx, (tex_file, result) in enumerate(zip(tex_files, results)):
+        report_compile(tex_file, result, format_path if idx not in failed else None)
+    return [result["success"] for result in results]
+
+
+def tex_path_for(selected_folder, image_name):
+    tex_filename = f"output_{os.path.splitext(image_name)[0]}"
+    return RESULTS_FOLDER / selected_folder / (tex_filename + ".tex")
 
 
 def get_latex_preamble(page_number, homework_number):
@@ -261,77 +757,12 @@ def display_and_choose_subfolder(subfolders):
             print("Invalid input. Please enter a number.")
 
 
-def modify_filename(filename):
-    # Regex to find '_###.' right before the extension
-    pattern = r"_(\d{3})\."
-
-    # Check if the filename matches the pattern
-    if re.search(pattern, filename):
-        # If the filename already has '_###.', return it unchanged
-        return filename
-    else:
-        # If not, add '_000' before the extension
-        return re.sub(r"\.", "_000.", filename)
-
-
-def sort_image_files(folder):
-    """
-    Sort image files by date and time extracted from their filenames,
-    with secondary sorting by optional sequence number.
-    """
-    image_files = os.listdir(folder)
-    pattern = re.compile(r"^signal-\d{4}-\d{2}-\d{2}-(\d{6})(?:_(\d{3}))?\.jpe?g$")
-
-    # Filter files to ensure they match the expected naming convention
-    valid_files = [file for file in image_files if pattern.match(file)]
-
-    # Extract and sort files based on the six-digit time and optional sequence number
-    valid_files.sort(
-        key=lambda name: (
-            int(pattern.search(name).group(1)),  # Time part as integer
-            int(pattern.search(name).group(2))
-            if pattern.search(name).group(2)
-            else 0,  # Sequence number or 0 if absent
-        )
-    )
-
-    return valid_files
-
-
-def sort_files_by_date_sequence(folder, file_extension, pattern_string):
-    """
-    Generalized function to sort files by date and time extracted from their filenames,
-    with secondary sorting by optional sequence number.
-    """
-    image_files = os.listdir(folder)
-    pattern = re.compile(pattern_string)
-
-    # Filter files to ensure they match the expected naming convention
-    valid_files = [
-        file for file in image_files if file.lower().endswith(file_extension)
-    ]
-
-    # Prepare sorting keys
-    new_matches = []
-    actually_valid_files = []
-    for name in valid_files:
-        match = pattern.search(name)
-        if match is not None:
-            actually_valid_files.append(name)
-            new_file = modify_filename(name)
-            new_match = pattern.search(new_file)
-            new_matches.append(new_match)
-    # Extract and sort files based on the six-digit time and optional sequence number
-    actually_valid_files.sort(
-        key=lambda name: (
-            int(pattern.search(name).group(1)),  # Time part as integer
-            int(pattern.search(name).group(2))
-            if pattern.search(name).group(2)
-            else 0,  # Sequence number or 0 if absent
-        )
-    )
-
-    return actually_valid_files
+def record_page_state(selected_folder, image_name, prompt_type, state, image_path=None):
+    """Note the progress of a whole page in the folder's manifest (strips aren't tracked)."""
+    if prompt_type == "piece_of_image":
+        return
+    manifest = job_manifest.manifest_for(RESULTS_FOLDER / selected_folder)
+    manifest.mark(image_name, state, image_path)
 
 
 def process_single_image(
@@ -343,61 +774,123 @@ def process_single_image(
     selected_folder,
     prompt_type="single_image",
     additional_context_before_latex_preamble="",
+    use_cache=True,
+    show_pdf=True,
 ):
-    """Process a single image, managing API interaction and response handling."""
-    while True:
-        response_data, latex_preamble = get_response(
-            openai_api_key,
-            latex_preamble,
-            base64_image,
-            prompt_type,
-            additional_context_before_latex_preamble,
-        )
-        next_action = handle_response(
-            response_data,
-            image_name,
-            page_number,
-            latex_preamble,
-            selected_folder,
-            prompt_type,
-        )
-        if next_action == "continue":
-            return get_continuation_text(response_data)  # Image processed successfully
-        elif next_action == "repeat":
-            continue  # Repeat processing for this image
+    """
+    Process a single image, managing API interaction and response handling. Gives up and
+    returns None after MAX_ATTEMPTS_PER_PAGE attempts.
+    """
+    with tracing.current_page(image_name), tracing.span(
+        "page", prompt_type=prompt_type
+    ) as page_record:
+        error_context = ""
+        for attempt in range(MAX_ATTEMPTS_PER_PAGE):
+            page_record["attempts"] = attempt + 1
+            record_page_state(selected_folder, image_name, prompt_type, "requested")
+            response_data, latex_preamble = get_response(
+                openai_api_key,
+                latex_preamble,
+                base64_image,
+                prompt_type,
+                error_context + additional_context_before_latex_preamble,
+                use_cache=use_cache,
+            )
+            # a cached answer that failed once would fail again, so retries always go out
+            use_cache = False
+            next_action = handle_response(
+                response_data,
+                image_name,
+                page_number,
+                latex_preamble,
+                selected_folder,
+                prompt_type,
+                show_pdf=show_pdf,
+            )
+            if next_action == "continue":
+                return get_continuation_text(response_data)  # Image processed successfully
+            errors = []
+            if next_action == "compile_failed":
+                errors = latex_compile.parse_latex_log(
+                    tex_path_for(selected_folder, image_name).with_suffix(".log")
+                )
+            elif next_action == "invalid_latex" or latex_validator.is_truncated(
+                response_data
+            ):
+                errors = validate_response(response_data, latex_preamble)
+            if errors:
+                error_context = (
+                    "A previous attempt at this page failed to compile with these errors, "
+                    "avoid them:\n" + latex_compile.format_errors(errors) + "\n\n"
+                )
+            print(f"Attempt {attempt + 1} of {MAX_ATTEMPTS_PER_PAGE} failed for {image_name}.")
+        print(f"Giving up on {image_name}.")
+        return None
+
+
+def future_result(future, default=None):
+    """
+    The result of a page's future, or default if it raised (after printing the traceback),
+    so that one broken page doesn't end the run for all the others.
+    """
+    try:
+        return future.result()
+    except Exception:
+        traceback.print_exc()
+        return default
 
 
 def process_image_in_pieces(
-    page_number, image_name, image_path, latex_preamble, openai_api_key, selected_folder
+    page_number,
+    image_name,
+    image_path,
+    latex_preamble,
+    openai_api_key,
+    selected_folder,
+    use_cache=True,
+    num_strips=None,
+    strip_overlap=None,
+    img=None,
 ):
-    """Process a image, managing API interaction and response handling."""
-    base64_image_first = encode_image_first_60pct(image_path)
-    response_first = process_single_image(
-        page_number,
-        "first_part_" + image_name,
-        base64_image_first,
-        latex_preamble,
-        openai_api_key,
-        selected_folder,
-        prompt_type="piece_of_image",
-    )
-    base64_image_last = encode_image_last_60pct(image_path)
-    response_second = process_single_image(
-        1 if page_number == 0 else page_number,
-        "second_part_" + image_name,
-        base64_image_first,
-        latex_preamble,
-        openai_api_key,
-        selected_folder,
-        prompt_type="piece_of_image",
-    )
-    base64_image = encode_image(image_path)
-    additional_context_before_latex_preamble = (
-        "Attempt at LaTex of first half of document:\n" + response_first + "\n\n"
-        "Attempt at LaTex of second half of document:\n" + response_second + "\n\n"
-        "The latex of the entire page:\n"
+    """
+    Process a image as overlapping horizontal strips (sent concurrently), then send the
+    whole page with the strip results as context. img is the page if it's decoded already.
+    """
+    if num_strips is None:
+        num_strips = NUM_STRIPS
+    if strip_overlap is None:
+        strip_overlap = STRIP_OVERLAP
+    base64_strips, base64_image = encode_image_strips(
+        image_path, num_strips, strip_overlap, img
     )
-    process_single_image(
+    with ThreadPoolExecutor(max_workers=num_strips) as executor:
+        futures = [
+            executor.submit(
+                process_single_image,
+                page_number,
+                f"part_{idx + 1}_" + image_name,
+                base64_strip,
+                latex_preamble,
+                openai_api_key,
+                selected_folder,
+                prompt_type="piece_of_image",
+                use_cache=use_cache,
+            )
+            for idx, base64_strip in enumerate(base64_strips)
+        ]
+        strip_responses = [future_result(future) for future in futures]
+
+    additional_context_before_latex_preamble = ""
+    for idx, strip_response in enumerate(strip_responses):
+        if strip_response is None:
+            print(f"No usable LaTeX for part {idx + 1}, leaving it out of the context.")
+            continue
+        additional_context_before_latex_preamble += (
+            f"Attempt at LaTex of part {idx + 1} of {num_strips} of the document "
+            "(counting from the top):\n" + strip_response + "\n\n"
+        )
+    additional_context_before_latex_preamble += "The latex of the entire page:\n"
+    return process_single_image(
         page_number,
         image_name,
         base64_image,
@@ -406,25 +899,50 @@ def process_image_in_pieces(
         selected_folder,
         prompt_type="combined_image",
         additional_context_before_latex_preamble=additional_context_before_latex_preamble,
+        use_cache=use_cache,
+    )
+
+
+def list_page_images(selected_folder):
+    """List the page images of the selected folder in page order."""
+    image_files = file_index.page_images(PSET_FOLDER / selected_folder)
+    if not DEDUPLICATE_PAGES:
+        return image_files
+    kept, dropped = page_dedup.find_duplicates(
+        [PSET_FOLDER / selected_folder / image_name for image_name in image_files]
     )
+    page_dedup.report_duplicates(dropped)
+    return [path.name for path in kept]
+
+
+def superseded_page_images(selected_folder):
+    """Photos of the folder that were replaced by a sharper retake of the same page."""
+    if not DEDUPLICATE_PAGES:
+        return set()
+    kept = set(list_page_images(selected_folder))
+    return set(file_index.page_images(PSET_FOLDER / selected_folder)) - kept
 
 
 def process_images(selected_folder, openai_api_key, homework_number):
     """Process each image file within the selected folder."""
-    pattern = re.compile(r"^signal-\d{4}-\d{2}-\d{2}-(\d{6})(?:_(\d{3}))?\.jpe?g$")
-    image_files = sort_files_by_date_sequence(
-        PSET_FOLDER / selected_folder, ".jpeg", pattern
-    )
+    image_files = list_page_images(selected_folder)
     print("")
     print("image_files!")
     print(image_files)
     print("")
+    manifest = job_manifest.manifest_for(RESULTS_FOLDER / selected_folder)
     for idx, image_name in enumerate(image_files):
         if image_name.lower().endswith((".jpg", ".jpeg", ".png")):
             page_number = idx + 1
             image_path = PSET_FOLDER / selected_folder / Path(image_name)
+            if manifest.is_done(image_name, image_path):
+                print(f"Page {page_number} ({image_name}) is already done, skipping.")
+                continue
+            img = None
             if SHOW_PAGE_IMAGE:
-                display_image(image_path)
+                # decoded once, for showing it and for every request of this page
+                img = open_page_image(image_path)
+                display_image(img)
             choice = input(
                 "process this image? All at once, in pieces (for longer pages), (a/p/n)\n"
             )
@@ -433,10 +951,12 @@ def process_images(selected_folder, openai_api_key, homework_number):
                 continue  # Exit the while loop if not processing the image
             else:
                 continue_processing = True
+                use_cache = True
                 while continue_processing:
                     latex_preamble = get_latex_preamble(page_number, homework_number)
                     if choice=="a":
                         print("Processing all at once.")
+                        manifest.mark(image_name, "encoded", image_path)
                         process_image_in_pieces(
                             page_number,
                             image_name,
@@ -444,10 +964,13 @@ def process_images(selected_folder, openai_api_key, homework_number):
                             latex_preamble,
                             openai_api_key,
                             selected_folder,
+                            use_cache=use_cache,
+                            img=img,
                         )
-                    elif choice="p":
+                    elif choice == "p":
                         print("processing piece by piece.")
-                        base64_image = encode_image(image_path)
+                        base64_image = encode_image(image_path, img)
+                        manifest.mark(image_name, "encoded", image_path)
                         process_single_image(
                             page_number,
                             image_name,
@@ -455,6 +978,7 @@ def process_images(selected_folder, openai_api_key, homework_number):
                             latex_preamble,
                             openai_api_key,
                             selected_folder,
+                            use_cache=use_cache,
                         )
                     # Ask if user is satisfied or wants to process again
                     if (
@@ -465,14 +989,409 @@ def process_images(selected_folder, openai_api_key, homework_number):
                     ):
                         print("Rerunning API call for OCR.")
                         continue_processing = True
+                        use_cache = False
                     else:
                         continue_processing = False
 
+    document_pages = collections.Counter(
+        page[0] for page in list_document_pages(selected_folder)
+    )
+    documents = [
+        document_path
+        for document_path, num_pages in document_pages.items()
+        if input(f"send the {num_pages} pages of {document_path.name}? (y/n)\n").lower()
+        == "y"
+    ]
+    if documents:
+        print("sending the pages of the scanned documents...")
+        process_documents(
+            selected_folder, openai_api_key, homework_number, documents=documents
+        )
+
+
+def list_document_pages(selected_folder):
+    """
+    (document path, page number in the document, page number, page name) for the pages of
+    the scanned documents in the folder, which come after the photos.
+    """
+    first_page_number = len(list_page_images(selected_folder)) + 1
+    pages = []
+    for document_name in document_input.list_documents(PSET_FOLDER / selected_folder):
+        document_path = PSET_FOLDER / selected_folder / document_name
+        # an unreadable document (or no pdf renderer) counts as no pages, with a warning
+        num_pages = document_input.readable_page_count(document_path)
+        for page_in_document in range(1, num_pages + 1):
+            pages.append(
+                (
+                    document_path,
+                    page_in_document,
+                    first_page_number + len(pages),
+                    document_input.page_name(document_path, page_in_document),
+                )
+            )
+    return pages
+
+
+def process_documents(
+    selected_folder, openai_api_key, homework_number, max_workers=None, documents=None
+):
+    """
+    Send the pages of the folder's scanned documents, or only of the document paths in
+    documents (at most max_workers in flight). Each page is rasterized only once there is
+    room for its request, and goes to the api straight from memory. Returns the page
+    names that never compiled.
+    """
+    if max_workers is None:
+        max_workers = MAX_CONCURRENT_REQUESTS
+    reserve_connections(max_workers)
+    manifest = job_manifest.manifest_for(RESULTS_FOLDER / selected_folder)
+    pages = list_document_pages(selected_folder)
+    if documents is not None:
+        pages = [page for page in pages if page[0] in documents]
+    failed = []
+    futures = {}
+
+    def collect(return_when):
+        done, _ = wait(futures, return_when=return_when)
+        for future in done:
+            if future_result(future) is None:
+                failed.append(futures[future])
+            del futures[future]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for document_path in dict.fromkeys(page[0] for page in pages):
+            document_hash = job_manifest.hash_image_file(document_path)
+            todo = {
+                page_in_document: (page_number, name)
+                for path, page_in_document, page_number, name in pages
+                if path == document_path
+                and not manifest.is_done(name, image_hash=document_hash)
+            }
+            for page_in_document, img in document_input.iter_readable_pages(
+                document_path, page_numbers=list(todo)
+            ):
+                page_number, name = todo[page_in_document]
+                with tracing.current_page(name):
+                    base64_image = encode_page_image(img, name)
+                manifest.mark(name, "encoded", image_hash=document_hash)
+                future = executor.submit(
+                    process_single_image,
+                    page_number,
+                    name,
+                    base64_image,
+                    get_latex_preamble(page_number, homework_number),
+                    openai_api_key,
+                    selected_folder,
+                    show_pdf=False,
+                )
+                futures[future] = name
+                # don't rasterize the next page until its request can go out
+                if len(futures) >= max_workers:
+                    collect(FIRST_COMPLETED)
+        if futures:
+            collect(ALL_COMPLETED)
+    return failed
+
+
+def request_page(
+    page_number,
+    image_name,
+    selected_folder,
+    openai_api_key,
+    homework_number,
+    use_cache=True,
+):
+    """Send a whole page to the api without asking the user anything."""
+    image_path = PSET_FOLDER / selected_folder / Path(image_name)
+    latex_preamble = get_latex_preamble(page_number, homework_number)
+    with tracing.current_page(image_name):
+        base64_image = encode_image(image_path)
+        record_page_state(
+            selected_folder, image_name, "single_image", "encoded", image_path
+        )
+        record_page_state(selected_folder, image_name, "single_image", "requested")
+        return get_response(
+            openai_api_key,
+            latex_preamble,
+            base64_image,
+            "single_image",
+            use_cache=use_cache,
+        )
+
+
+def encode_document_page(document_path, page_in_document, page_name):
+    """Rasterize and encode one page of a scanned document, or None if it can't be read."""
+    for _, img in document_input.iter_readable_pages(
+        document_path, page_numbers=[page_in_document]
+    ):
+        return encode_page_image(img, page_name)
+    return None
+
+
+def request_document_page(
+    page_number,
+    document_path,
+    page_in_document,
+    page_name,
+    selected_folder,
+    openai_api_key,
+    homework_number,
+    document_hash=None,
+    use_cache=True,
+):
+    """Send one page of a scanned document to the api without asking the user anything."""
+    latex_preamble = get_latex_preamble(page_number, homework_number)
+    manifest = job_manifest.manifest_for(RESULTS_FOLDER / selected_folder)
+    with tracing.current_page(page_name):
+        base64_image = encode_document_page(document_path, page_in_document, page_name)
+        if base64_image is None:
+            return None, latex_preamble
+        manifest.mark(page_name, "encoded", document_path, image_hash=document_hash)
+        manifest.mark(page_name, "requested")
+        return get_response(
+            openai_api_key,
+            latex_preamble,
+            base64_image,
+            "single_image",
+            use_cache=use_cache,
+        )
+
 
-def display_image(image_path):
-    """Display an image using matplotlib."""
-    img = plt.imread(image_path)
-    plt.imshow(img)
+def split_packed_response(response_data, num_pages):
+    """
+    Split the reply to a packed request into one response_data per page, or None if its
+    page markers don't number the pages 1 to num_pages in order.
+    """
+    if not response_data or not response_data.get("choices"):
+        return None
+    choice = response_data["choices"][0]
+    content = choice["message"]["content"]
+    markers = list(PAGE_MARKER_PATTERN.finditer(content))
+    if [int(marker.group(1)) for marker in markers] != list(range(1, num_pages + 1)):
+        return None
+    page_responses = []
+    for idx, marker in enumerate(markers):
+        is_last = idx == len(markers) - 1
+        end = len(content) if is_last else markers[idx + 1].start()
+        page_responses.append(
+            {
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": content[marker.end() : end],
+                        },
+                        # only the last page can have been cut off by max_tokens
+                        "finish_reason": choice.get("finish_reason") if is_last else "stop",
+                    }
+                ]
+            }
+        )
+    return page_responses
+
+
+def request_pack(pack, selected_folder, openai_api_key, homework_number, use_cache=True):
+    """
+    Send consecutive pages, a list of (page_number, image_name), in one request. Returns
+    one response_data per page (or None if the reply couldn't be split into pages), and
+    the reply itself, which is only cached once all of its pages compiled.
+    """
+    base64_images = []
+    for page_number, image_name in pack:
+        image_path = PSET_FOLDER / selected_folder / Path(image_name)
+        with tracing.current_page(image_name):
+            base64_images.append(encode_image(image_path))
+        record_page_state(
+            selected_folder, image_name, "single_image", "encoded", image_path
+        )
+        record_page_state(selected_folder, image_name, "single_image", "requested")
+    with tracing.current_page(",".join(image_name for _, image_name in pack)):
+        response_data, _ = get_response(
+            openai_api_key,
+            get_latex_preamble(pack[0][0], homework_number),
+            base64_images,
+            "multi_page",
+            f"The {len(pack)} images are consecutive pages of this document:\n",
+            use_cache=use_cache,
+        )
+    return split_packed_response(response_data, len(pack)), response_data
+
+
+def process_images_concurrently(
+    selected_folder,
+    openai_api_key,
+    homework_number,
+    max_workers=None,
+    pages_per_request=None,
+):
+    """
+    Send all pages to the api at once (at most max_workers in flight) and compile each
+    page as soon as its response comes back. With pages_per_request above 1, consecutive
+    pages are packed into one request first, and any page that can't be split out of the
+    reply or doesn't compile is sent again on its own. Returns the image names that never
+    compiled.
+    """
+    if max_workers is None:
+        max_workers = MAX_CONCURRENT_REQUESTS
+    reserve_connections(max_workers)
+    if pages_per_request is None:
+        pages_per_request = PAGES_PER_REQUEST
+    if pages_per_request * MAX_TOKENS > MAX_OUTPUT_TOKENS:
+        # a bigger pack couldn't be answered in full in one reply
+        pages_per_request = max(1, MAX_OUTPUT_TOKENS // MAX_TOKENS)
+        print(f"packing at most {pages_per_request} pages per request")
+    manifest = job_manifest.manifest_for(RESULTS_FOLDER / selected_folder)
+    all_image_files = list_page_images(selected_folder)
+    # page numbers are fixed up front so the order never depends on which call returns first
+    page_numbers = {
+        image_name: idx + 1 for idx, image_name in enumerate(all_image_files)
+    }
+    image_files = [
+        image_name
+        for image_name in all_image_files
+        if not manifest.is_done(
+            image_name, PSET_FOLDER / selected_folder / Path(image_name)
+        )
+    ]
+    print(f"sending {len(image_files)} pages, {max_workers} at a time...")
+
+    attempts = {image_name: 0 for image_name in image_files}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def submit(page_number, image_name):
+            attempts[image_name] += 1
+            future = executor.submit(
+                request_page,
+                page_number,
+                image_name,
+                selected_folder,
+                openai_api_key,
+                homework_number,
+                use_cache=attempts[image_name] == 1,
+            )
+            pending[future] = (page_number, image_name)
+
+        def finish(page_number, image_name, response_data, latex_preamble):
+            next_action = handle_response(
+                response_data,
+                image_name,
+                page_number,
+                latex_preamble,
+                selected_folder,
+                "single_image",
+                show_pdf=False,
+            )
+            if next_action == "continue":
+                return True
+            if attempts[image_name] < MAX_ATTEMPTS_PER_PAGE:
+                submit(page_number, image_name)
+            else:
+                print(f"giving up on page {page_number} ({image_name})")
+                failed.append(image_name)
+            return False
+
+        for start in range(0, len(image_files), max(1, pages_per_request)):
+            pack = [
+                (page_numbers[image_name], image_name)
+                for image_name in image_files[start : start + max(1, pages_per_request)]
+            ]
+            if len(pack) == 1:
+                submit(*pack[0])
+                continue
+            future = executor.submit(
+                request_pack, pack, selected_folder, openai_api_key, homework_number
+            )
+            pending[future] = pack
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                if isinstance(job, list):
+                    # a pack that raised is sent again page by page, like one that
+                    # couldn't be split
+                    page_responses, pack_response = future_result(future, (None, None))
+                    if page_responses is None:
+                        remember_response(pack_response, compiled=False)
+                        print(
+                            f"couldn't split the reply for pages {job[0][0]}-{job[-1][0]}, "
+                            "sending them one at a time"
+                        )
+                        for page_number, image_name in job:
+                            submit(page_number, image_name)
+                        continue
+                    compiled = [
+                        finish(
+                            page_number,
+                            image_name,
+                            response_data,
+                            get_latex_preamble(page_number, homework_number),
+                        )
+                        for (page_number, image_name), response_data in zip(
+                            job, page_responses
+                        )
+                    ]
+                    remember_response(pack_response, all(compiled))
+                    continue
+                page_number, image_name = job
+                # a page that raised counts as an attempt without a response
+                response_data, latex_preamble = future_result(future, (None, None))
+                finish(page_number, image_name, response_data, latex_preamble)
+    return failed + process_documents(
+        selected_folder, openai_api_key, homework_number, max_workers
+    )
+
+
+def process_images_in_pieces_concurrently(
+    selected_folder, openai_api_key, homework_number, max_workers=None
+):
+    """
+    Like process_images_concurrently, but every page is processed in strips first.
+    Returns the image names that never compiled.
+    """
+    if max_workers is None:
+        max_workers = MAX_CONCURRENT_REQUESTS
+    # every page has its strips in flight at once
+    reserve_connections(max_workers * NUM_STRIPS)
+    manifest = job_manifest.manifest_for(RESULTS_FOLDER / selected_folder)
+    futures = {}
+    print(f"sending pages in pieces, {max_workers} pages at a time...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for idx, image_name in enumerate(list_page_images(selected_folder)):
+            page_number = idx + 1
+            image_path = PSET_FOLDER / selected_folder / Path(image_name)
+            if manifest.is_done(image_name, image_path):
+                continue
+            manifest.mark(image_name, "encoded", image_path)
+            future = executor.submit(
+                process_image_in_pieces,
+                page_number,
+                image_name,
+                image_path,
+                get_latex_preamble(page_number, homework_number),
+                openai_api_key,
+                selected_folder,
+            )
+            futures[future] = image_name
+    failed = [
+        image_name for future, image_name in futures.items() if future_result(future) is None
+    ]
+    # scanned documents are sent whole, since their pages are short already
+    return failed + process_documents(
+        selected_folder, openai_api_key, homework_number, max_workers
+    )
+
+
+def display_image(img):
+    """Display an image (a path, or an image decoded already) using matplotlib."""
+    import matplotlib.pyplot as plt
+
+    if isinstance(img, (str, Path)):
+        img = plt.imread(img)
+    plt.imshow(img, cmap="gray")
     plt.axis("off")  # Hide axes
     plt.show()
 
@@ -487,20 +1406,52 @@ def view_latex_pdf(pdf_path):
 
 
 def handle_response(
-    response_data, image_name, page_number, latex_preamble, selected_folder, prompt_type
+    response_data,
+    image_name,
+    page_number,
+    latex_preamble,
+    selected_folder,
+    prompt_type,
+    show_pdf=True,
+):
+    """Handle the server response for each image, caching it if it compiled."""
+    next_action = write_and_compile_response(
+        response_data,
+        image_name,
+        page_number,
+        latex_preamble,
+        selected_folder,
+        prompt_type,
+        show_pdf,
+    )
+    remember_response(response_data, next_action == "continue")
+    return next_action
+
+
+def write_and_compile_response(
+    response_data,
+    image_name,
+    page_number,
+    latex_preamble,
+    selected_folder,
+    prompt_type,
+    show_pdf,
 ):
-    """Handle the server response for each image."""
     if response_data:
-        tex_filename = f"output_{os.path.splitext(image_name)[0]}"
-        tex_path = RESULTS_FOLDER / selected_folder / (tex_filename + ".tex")
-        pdf_path = RESULTS_FOLDER / selected_folder / (tex_filename + ".pdf")
+        record_page_state(selected_folder, image_name, prompt_type, "response_received")
+        tex_path = tex_path_for(selected_folder, image_name)
+        pdf_path = tex_path.with_suffix(".pdf")
         next_action = save_response_as_tex(response_data, latex_preamble, tex_path)
         if next_action == "success":
-            if compile_latex(tex_path):
+            record_page_state(selected_folder, image_name, prompt_type, "tex_written")
+            with tracing.current_page(image_name):
+                compiled = compile_latex(tex_path)
+            if compiled:
+                record_page_state(selected_folder, image_name, prompt_type, "compiled")
                 print(
                     f"\nCompiled the LaTeX for written page number {page_number}. Continuing.\n"
                 )
-                if SHOW_COMPILED_PDF and (
+                if show_pdf and SHOW_COMPILED_PDF and (
                     prompt_type == "single_image" or prompt_type == "combined_image"
                 ):
                     if not view_latex_pdf(pdf_path):
@@ -508,7 +1459,10 @@ def handle_response(
                 return "continue"
             else:
                 print("Error compiling LaTeX. Trying api call again.")
-                return "try_again"
+                return "compile_failed"
+        elif next_action == "invalid_latex":
+            print("Invalid LaTeX. Trying api call again.")
+            return "invalid_latex"
         else:
             print("Error saving response as LaTeX. Trying api call again.")
             return "try_again"
@@ -517,63 +1471,268 @@ def handle_response(
         return "try_again"
 
 
+# lines of the page preambles, which are left out of the consolidated document
+PREAMBLE_LINE_PATTERN = re.compile(
+    r"\s*(?:"
+    + "|".join(
+        re.escape(prefix)
+        for prefix in [
+            "\\documentclass[fleqn]{article}",
+            "\\usepackage{fancyhdr}",
+            "\\usepackage{amsmath}",
+            "\\usepackage{amssymb}",
+            "\\pagestyle{fancy}",
+            "\\fancyhf{}",
+            "\\fancypagestyle{firstpage}{\\fancyhf{}\\fancyhead[R]{\\textbf{",
+            "\\fancyhead[R]{\\thepage}",
+            "\\renewcommand{\\headrulewidth}{0pt}",
+            "\\usepackage{enumitem}",
+            "\\setlist[enumerate]{align=left, labelwidth=*, itemindent=1em, leftmargin=*}",
+            "\\begin{document}",
+            "\\thispagestyle{firstpage}\\vspace*{10pt}\\section*{",
+            "\\setcounter{page}{",
+            "\\end{document}",
+        ]
+    )
+    + ")"
+)
+CONSOLIDATE_CACHE_NAME = "consolidate_cache.json"  # page bodies from the last consolidation
+
+
+def page_body(tex_path, cached):
+    """
+    The page's cache entry, with its body (the page without its preamble lines). cached,
+    the entry from the last consolidation, is reused if the file's size and mtime or
+    failing that its hash haven't changed. Also returns whether the file had to be read.
+    """
+    stat = os.stat(tex_path)
+    if (
+        cached is not None
+        and cached["size"] == stat.st_size
+        and cached["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return cached, False
+    with open(tex_path, "rb") as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if cached is not None and cached["sha256"] == digest:
+        body = cached["body"]
+    else:
+        body = "".join(
+            line
+            for line in data.decode("utf-8").splitlines(keepends=True)
+            if not PREAMBLE_LINE_PATTERN.match(line)
+        )
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": digest,
+        "body": body,
+    }, True
+
+
 def consolidate_tex_files_sorted(results_folder, homework_number):
+    """
+    Join the pages of a folder into consolidated_output.tex and compile it. Only the pages
+    that changed since the last run are read, and if none did the file is left alone (and
+    so isn't compiled again either).
+    """
     end_document = "\\end{document}"
-    consolidated_content = ""
-
-    # Define the pattern for `.tex` files
-    pattern = re.compile(r"^output_signal-\d{4}-\d{2}-\d{2}-(\d{6})(?:_(\d{3}))?\.tex$")
 
-    tex_files = sort_files_by_date_sequence(results_folder, ".tex", pattern)
+    tex_files = file_index.page_tex_files(results_folder)
+    selected_folder = Path(results_folder).name
+    if (PSET_FOLDER / selected_folder).is_dir():
+        # a page done before a sharper retake of it arrived is left out, the retake has
+        # its own output
+        superseded = {
+            tex_path_for(selected_folder, image_name).name
+            for image_name in superseded_page_images(selected_folder)
+        }
+        tex_files = [name for name in tex_files if name not in superseded]
+    # pages of scanned documents come after the photos, in document order
+    tex_files += [
+        name
+        for name in file_index.file_names(results_folder)
+        if document_input.DOCUMENT_TEX_PATTERN.match(name)
+    ]
 
     actual_latex_preamble = get_latex_preamble(
         page_number=1, homework_number=homework_number
     )
-    latex_preamble_search_strings_to_remove = [
-        "\\documentclass[fleqn]{article}",
-        "\\usepackage{fancyhdr}",
-        "\\usepackage{amsmath}",
-        "\\usepackage{amssymb}",
-        "\\pagestyle{fancy}",
-        "\\fancyhf{}",
-        "\\fancypagestyle{firstpage}{\\fancyhf{}\\fancyhead[R]{\\textbf{",
-        "\\fancyhead[R]{\\thepage}",
-        "\\renewcommand{\\headrulewidth}{0pt}",
-        "\\usepackage{enumitem}",
-        "\\setlist[enumerate]{align=left, labelwidth=*, itemindent=1em, leftmargin=*}",
-        "\\begin{document}",
-        "\\thispagestyle{firstpage}\\vspace*{10pt}\\section*{",
-        "\\setcounter{page}{",
-        "\\end{document}",
-    ]
-    for tex_file in tex_files:
-        with open(results_folder / tex_file, "r") as file:
-            lines = file.readlines()
-
-        filtered_content = ""
-        for line in lines:
-            if not any(
-                line.strip().startswith(preamble)
-                for preamble in latex_preamble_search_strings_to_remove
-            ):
-                filtered_content += line
-
-        consolidated_content += filtered_content + "\n"
-
     final_tex_path = results_folder / "consolidated_output.tex"
-    with open(final_tex_path, "w") as file:
-        file.write(actual_latex_preamble + consolidated_content + end_document)
+    cache_path = results_folder / CONSOLIDATE_CACHE_NAME
+    try:
+        with open(cache_path, "r") as file:
+            cache = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {"pages": {}, "consolidated": None}
+
+    with tracing.span("consolidate", bytes_in=0, pages_read=0) as record:
+        pages = {}
+        for tex_file in tex_files:
+            pages[tex_file], was_read = page_body(
+                results_folder / tex_file, cache["pages"].get(tex_file)
+            )
+            if was_read:
+                record["bytes_in"] += pages[tex_file]["size"]
+                record["pages_read"] += 1
+        digest = hashlib.sha256(actual_latex_preamble.encode("utf-8"))
+        for tex_file in tex_files:
+            digest.update(f"{tex_file}:{pages[tex_file]['sha256']}\n".encode("utf-8"))
+        digest = digest.hexdigest()
+
+        if digest == cache["consolidated"] and final_tex_path.exists():
+            record["skipped"] = True
+            print("no page changed since the last consolidation")
+        else:
+            # write the pages out one by one instead of building the document in memory
+            tmp_path = final_tex_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as file:
+                file.write(actual_latex_preamble)
+                for tex_file in tex_files:
+                    file.write(pages[tex_file]["body"])
+                    file.write("\n")
+                file.write(end_document)
+            os.replace(tmp_path, final_tex_path)
+            record["bytes_out"] = os.path.getsize(final_tex_path)
+        if record["pages_read"] or digest != cache["consolidated"]:
+            tmp_path = cache_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as file:
+                json.dump({"pages": pages, "consolidated": digest}, file)
+            os.replace(tmp_path, cache_path)
 
     print(f"Consolidated file created at: {final_tex_path}")
     print("compiling...")
-    compile_latex(final_tex_path)
-    print("compiled")
+    compiled = compile_latex(final_tex_path)
+    print("compiled" if compiled else "the consolidated file failed to compile")
+    return compiled
+
+
+def page_report(selected_folder):
+    """(folder, page number, image name, manifest state) for every page of a folder."""
+    manifest = job_manifest.manifest_for(RESULTS_FOLDER / selected_folder)
+    return [
+        (
+            str(selected_folder),
+            idx + 1,
+            image_name,
+            manifest.pages.get(image_name, {}).get("state", "not started"),
+        )
+        for idx, image_name in enumerate(list_page_images(selected_folder))
+    ] + [
+        (
+            str(selected_folder),
+            page_number,
+            name,
+            manifest.pages.get(name, {}).get("state", "not started"),
+        )
+        for _, _, page_number, name in list_document_pages(selected_folder)
+    ]
 
 
-# Update the call to use the correct results directory, for example:
+def run_headless(folders, homework_number, mode, concurrency, pages_per_request=None):
+    """
+    Process the given folders without any prompts or windows, then print a report of every
+    page. Returns the exit code: 0 if every page and consolidated file compiled, else 1.
+    """
+    global SHOW_COMPILED_PDF, SHOW_PAGE_IMAGE
+    SHOW_COMPILED_PDF = False
+    SHOW_PAGE_IMAGE = False
+    openai_api_key = load_parameters()["openai_api_key"]
+    if USE_RESPONSE_CACHE:
+        response_cache.evict_cache()
+
+    report = []
+    failed_consolidations = []
+    for folder in folders:
+        selected_folder = Path(folder)
+        (RESULTS_FOLDER / selected_folder).mkdir(parents=True, exist_ok=True)
+        tracing.start_trace(RESULTS_FOLDER / selected_folder / TRACE_FILE_NAME)
+        if mode == "pieces":
+            process_images_in_pieces_concurrently(
+                selected_folder, openai_api_key, homework_number, concurrency
+            )
+        else:
+            process_images_concurrently(
+                selected_folder,
+                openai_api_key,
+                homework_number,
+                concurrency,
+                pages_per_request,
+            )
+        if not consolidate_tex_files_sorted(
+            RESULTS_FOLDER / selected_folder, homework_number
+        ):
+            failed_consolidations.append(str(selected_folder))
+        tracing.print_summary()
+        report += page_report(selected_folder)
 
+    print("")
+    print(f"{'folder':<24} {'page':>4}  {'image':<36} state")
+    for folder, page_number, image_name, state in report:
+        print(f"{folder:<24} {page_number:>4}  {image_name:<36} {state}")
+    failed_pages = [row for row in report if row[3] != "compiled"]
+    print(f"{len(report) - len(failed_pages)} of {len(report)} pages compiled")
+    for folder in failed_consolidations:
+        print(f"consolidated file of {folder} failed to compile")
+    return 1 if failed_pages or failed_consolidations else 0
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Turn photos of a pset into LaTeX. Without folders, asks what to do "
+        "interactively."
+    )
+    parser.add_argument(
+        "folders", nargs="*", help='folders inside the psets folder, or "all"'
+    )
+    parser.add_argument("--homework", type=int, help="homework number")
+    parser.add_argument(
+        "--mode",
+        choices=["whole", "pieces"],
+        default="whole",
+        help="send each page whole, or in strips first (for long pages)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=MAX_CONCURRENT_REQUESTS,
+        help="pages in flight at once",
+    )
+    parser.add_argument(
+        "--pages-per-request",
+        type=int,
+        default=PAGES_PER_REQUEST,
+        help="consecutive pages packed into one request (whole mode only)",
+    )
+    parser.add_argument(
+        "--output-dir", type=Path, default=RESULTS_FOLDER, help="where results go"
+    )
+    args = parser.parse_args(argv)
+    if args.folders and args.homework is None:
+        parser.error("--homework is required when folders are given")
+    return args
+
+
+def main(argv=None):
+    global RESULTS_FOLDER
+    args = parse_arguments(argv)
+    RESULTS_FOLDER = args.output_dir
+    RESULTS_FOLDER.mkdir(parents=True, exist_ok=True)
+    if args.folders:
+        folders = args.folders
+        if folders == ["all"]:
+            folders = sorted(list_subfolders(PSET_FOLDER))
+        sys.exit(
+            run_headless(
+                folders,
+                args.homework,
+                args.mode,
+                args.concurrency,
+                args.pages_per_request,
+            )
+        )
 
-def main():
     params = load_parameters()
     openai_api_key = params["openai_api_key"]
 
@@ -583,9 +1742,16 @@ def main():
     print("selected_folder")
     print(selected_folder)
     (RESULTS_FOLDER / selected_folder).mkdir(parents=True, exist_ok=True)
-    process_images(selected_folder, openai_api_key, homework_number)
+    tracing.start_trace(RESULTS_FOLDER / selected_folder / TRACE_FILE_NAME)
+    if USE_RESPONSE_CACHE:
+        response_cache.evict_cache()
+    if CONCURRENT_MODE:
+        process_images_concurrently(selected_folder, openai_api_key, homework_number)
+    else:
+        process_images(selected_folder, openai_api_key, homework_number)
 
     consolidate_tex_files_sorted(RESULTS_FOLDER / selected_folder, homework_number)
+    tracing.print_summary()
 
 
 if __name__ == "__main__":
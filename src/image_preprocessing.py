@@ -0,0 +1,66 @@
+import os
+import io
+
+# PIL is imported inside the functions, so importing this module (and gpt4_to_tex) stays cheap
+
+# Each step can be turned off on its own (None/False) to tune the size vs accuracy tradeoff.
+FIX_EXIF_ORIENTATION = True
+# gpt-4 vision scales high detail images to fit 2048x2048 (and the short side to 768),
+# so anything bigger is only paid for in upload time
+MAX_LONG_EDGE = 2048
+CONVERT_TO_GRAYSCALE = True
+AUTOCONTRAST_CUTOFF = 1  # percent of darkest/lightest pixels to clip, None to skip
+THRESHOLD = None  # 0-255, pixels above become white and the rest black, None to skip
+JPEG_QUALITY = 85
+
+
+def preprocess_image(img):
+    """Apply the configured preprocessing steps to a PIL image, returning a new image."""
+    from PIL import Image, ImageOps
+
+    if FIX_EXIF_ORIENTATION:
+        # phones store rotation in the exif header rather than rotating the pixels
+        img = ImageOps.exif_transpose(img)
+    if MAX_LONG_EDGE and max(img.size) > MAX_LONG_EDGE:
+        scale = MAX_LONG_EDGE / max(img.size)
+        new_size = (round(img.width * scale), round(img.height * scale))
+        img = img.resize(new_size, Image.LANCZOS)
+    if CONVERT_TO_GRAYSCALE:
+        img = ImageOps.grayscale(img)
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if AUTOCONTRAST_CUTOFF is not None:
+        img = ImageOps.autocontrast(img, cutoff=AUTOCONTRAST_CUTOFF)
+    if THRESHOLD is not None:
+        img = img.convert("L").point(lambda p: 255 if p > THRESHOLD else 0)
+    return img
+
+
+def jpeg_bytes(img, quality=None):
+    if quality is None:
+        quality = JPEG_QUALITY
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    # a view of the buffer rather than a copy, base64 and file writes take it as is
+    return buffer.getbuffer()
+
+
+def preprocess_file(image_path):
+    """Return the preprocessed image as JPEG bytes, printing the size before and after."""
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        data = jpeg_bytes(preprocess_image(img))
+    report_size(image_path, data)
+    return data
+
+
+def report_size(image_path, data):
+    """Print the size of the photo and of data, the preprocessed JPEG of it."""
+    bytes_before = os.path.getsize(image_path)
+    print(
+        f"{os.path.basename(image_path)}: {bytes_before / 1024:.0f} kB -> "
+        f"{len(data) / 1024:.0f} kB ({100 * len(data) / bytes_before:.0f}%)"
+    )
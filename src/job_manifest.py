@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+# in the order a page goes through them
+PAGE_STATES = ("encoded", "requested", "response_received", "tex_written", "compiled")
+
+
+def hash_image_file(image_path):
+    hasher = hashlib.sha256()
+    with open(image_path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class JobManifest:
+    """
+    Record of how far each page of a results folder got, saved next to the results as
+    manifest.json so that a restarted run can skip the pages which are already finished.
+    """
+
+    def __init__(self, results_folder):
+        self.path = Path(results_folder) / MANIFEST_NAME
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r") as file:
+                self.pages = json.load(file)["pages"]
+        except FileNotFoundError:
+            self.pages = {}
+
+    def is_done(self, image_name, image_path=None, image_hash=None):
+        """
+        True if the page compiled before and its image hasn't changed since. Pages of a
+        document pass the document's hash instead of a path.
+        """
+        entry = self.pages.get(image_name)
+        if entry is None or entry["state"] != "compiled":
+            return False
+        if image_hash is None:
+            image_hash = hash_image_file(image_path)
+        return entry.get("image_hash") == image_hash
+
+    def mark(self, image_name, state, image_path=None, image_hash=None):
+        """Move a page to a new state. Pass image_path to (re)record the image hash."""
+        assert state in PAGE_STATES, f"unknown page state {state}"
+        if image_hash is None and image_path is not None:
+            image_hash = hash_image_file(image_path)
+        with self.lock:
+            entry = self.pages.setdefault(image_name, {})
+            if image_hash is not None:
+                entry["image_hash"] = image_hash
+            entry["state"] = state
+            entry["updated"] = datetime.now().isoformat(timespec="seconds")
+            self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump({"pages": self.pages}, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def manifest_for(results_folder):
+    """Shared manifest for a results folder, so threads never overwrite each other."""
+    key = os.path.abspath(results_folder)
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = JobManifest(results_folder)
+        return _manifests[key]
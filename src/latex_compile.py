@@ -0,0 +1,116 @@
+import os
+import re
+import time
+import hashlib
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+COMPILE_TIMEOUT_SECONDS = 60
+MAX_COMPILE_WORKERS = os.cpu_count() or 4
+
+
+def parse_latex_log(log_path):
+    """Pull the errors out of a pdflatex log as {"message", "line", "context"} records."""
+    try:
+        with open(log_path, "r", encoding="latin-1") as log_file:
+            lines = log_file.read().splitlines()
+    except FileNotFoundError:
+        return []
+    errors = []
+    for idx, line in enumerate(lines):
+        if not line.startswith("! "):
+            continue
+        error = {"message": line[2:].strip(), "line": None, "context": ""}
+        # the offending source line follows a few lines later as "l.<number> <text>"
+        for following in lines[idx + 1 : idx + 15]:
+            match = re.match(r"l\.(\d+) ?(.*)", following)
+            if match:
+                error["line"] = int(match.group(1))
+                error["context"] = match.group(2).strip()
+                break
+        errors.append(error)
+    return errors
+
+
+def format_errors(errors):
+    return "\n".join(
+        f"line {error['line']}: {error['message']}"
+        + (f" (at {error['context']})" if error["context"] else "")
+        for error in errors
+    )
+
+
+def fingerprint(tex_file, command):
+    hasher = hashlib.sha256()
+    hasher.update(" ".join(command).encode("utf-8"))
+    with open(tex_file, "rb") as file:
+        hasher.update(file.read())
+    return hasher.hexdigest()
+
+
+def compile_tex(tex_file, format_path=None, timeout=COMPILE_TIMEOUT_SECONDS, force=False):
+    """
+    Compile a .tex file without ever stopping for input. Unless force is set, files whose
+    content matches their last successful compile are skipped. Returns a dict with
+    "success", "skipped", "seconds" and the parsed log "errors".
+    """
+    tex_file = Path(tex_file)
+    command = ["pdflatex", "-interaction=nonstopmode", "-halt-on-error"]
+    if format_path is not None:
+        command.append(f"-fmt={format_path}")
+    command.append(tex_file.name)
+
+    fingerprint_path = tex_file.with_suffix(".fingerprint")
+    current_fingerprint = fingerprint(tex_file, command)
+    if (
+        not force
+        and tex_file.with_suffix(".pdf").exists()
+        and fingerprint_path.exists()
+        and fingerprint_path.read_text() == current_fingerprint
+    ):
+        return {"success": True, "skipped": True, "seconds": 0.0, "errors": []}
+
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(
+            command,
+            cwd=tex_file.parent,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=timeout,
+        )
+        success = result.returncode == 0
+        errors = [] if success else parse_latex_log(tex_file.with_suffix(".log"))
+    except subprocess.TimeoutExpired:
+        success = False
+        errors = [
+            {"message": f"pdflatex timed out after {timeout}s", "line": None, "context": ""}
+        ]
+    if success:
+        fingerprint_path.write_text(current_fingerprint)
+    elif fingerprint_path.exists():
+        fingerprint_path.unlink()
+    return {
+        "success": success,
+        "skipped": False,
+        "seconds": time.perf_counter() - start,
+        "errors": errors,
+    }
+
+
+def compile_many(tex_files, format_path=None, max_workers=None, force=False):
+    """
+    Compile many files side by side, each worker driving its own pdflatex process.
+    Returns the results in the same order as tex_files.
+    """
+    if max_workers is None:
+        max_workers = MAX_COMPILE_WORKERS
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(
+            executor.map(
+                lambda tex_file: compile_tex(tex_file, format_path, force=force),
+                tex_files,
+            )
+        )
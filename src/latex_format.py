@@ -0,0 +1,109 @@
+"""
+Precompiled LaTeX format for the fixed part of the preamble. Loading the class and
+packages (fancyhdr, amsmath, amssymb, enumitem) takes most of the time of compiling a one
+page document, so they are dumped once into a .fmt file which every compile then starts
+from. To compare compile times with and without it:
+
+    python3 latex_format.py ../results/<folder>/output_<image>.tex
+"""
+import sys
+import time
+import hashlib
+import threading
+import subprocess
+from pathlib import Path
+
+_build_lock = threading.Lock()
+_pdflatex_version = None
+
+
+def format_source(preamble_lines):
+    return (
+        "\n".join(
+            preamble_lines
+            + [
+                # documents compiled with the format still start with \documentclass,
+                # so make it a no-op (loading an already loaded package is one already)
+                "\\makeatletter",
+                "\\renewcommand{\\documentclass}[2][]{}",
+                "\\makeatother",
+                "\\dump",
+            ]
+        )
+        + "\n"
+    )
+
+
+def pdflatex_version():
+    """The output of pdflatex --version, read once. A format only loads in the same build."""
+    global _pdflatex_version
+    if _pdflatex_version is None:
+        try:
+            _pdflatex_version = subprocess.run(
+                ["pdflatex", "--version"],
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                text=True,
+            ).stdout
+        except OSError:
+            _pdflatex_version = ""
+    return _pdflatex_version
+
+
+def ensure_format(preamble_lines, format_folder):
+    """
+    Build the format for these preamble lines and this pdflatex unless it exists already.
+    Returns the format path without the .fmt suffix (as pdflatex -fmt wants it), or None
+    if the build failed.
+    """
+    source = format_source(preamble_lines)
+    hasher = hashlib.sha256(source.encode("utf-8"))
+    # a format dumped by another pdflatex (after a texlive update) refuses to load
+    hasher.update(pdflatex_version().encode("utf-8"))
+    name = "preamble-" + hasher.hexdigest()[:12]
+    format_folder = Path(format_folder).resolve()
+    with _build_lock:
+        if not (format_folder / (name + ".fmt")).exists():
+            print("building the precompiled preamble...")
+            format_folder.mkdir(parents=True, exist_ok=True)
+            with open(format_folder / (name + ".tex"), "w") as file:
+                file.write(source)
+            result = subprocess.run(
+                [
+                    "pdflatex",
+                    "-ini",
+                    "-interaction=nonstopmode",
+                    f"-jobname={name}",
+                    "&pdflatex",
+                    name + ".tex",
+                ],
+                cwd=format_folder,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+            )
+            if result.returncode != 0:
+                print("failed to build the precompiled preamble, compiling without it")
+                return None
+    return format_folder / name
+
+
+def compare_compile_times(tex_file, runs=3):
+    """Compile tex_file with and without the format and print the mean wall time of each."""
+    import gpt4_to_tex
+
+    timings = {}
+    for use_format in (False, True):
+        # the first compile with the format also builds it, so it isn't timed
+        gpt4_to_tex.compile_latex(tex_file, use_format=use_format, force=True)
+        start = time.perf_counter()
+        for _ in range(runs):
+            gpt4_to_tex.compile_latex(tex_file, use_format=use_format, force=True)
+        timings[use_format] = (time.perf_counter() - start) / runs
+    print(f"without precompiled preamble: {timings[False]:.2f}s per compile")
+    print(f"with precompiled preamble:    {timings[True]:.2f}s per compile")
+    print(f"speedup: {timings[False] / timings[True]:.1f}x")
+    return timings
+
+
+if __name__ == "__main__":
+    compare_compile_times(Path(sys.argv[1]))
@@ -0,0 +1,155 @@
+"""
+Cheap checks of model output which catch the usual ways it fails to compile, without
+starting pdflatex. Problems are reported in the same {"message", "line", "context"} form
+as the compile errors parsed by latex_compile.parse_latex_log.
+"""
+import re
+import bisect
+
+# environments provided by the article class and the packages in get_latex_preamble
+KNOWN_ENVIRONMENTS = {
+    # article
+    "document", "abstract", "array", "center", "description", "displaymath",
+    "enumerate", "eqnarray", "eqnarray*", "equation", "figure", "figure*",
+    "flushleft", "flushright", "itemize", "list", "math", "minipage", "picture",
+    "quotation", "quote", "table", "table*", "tabbing", "tabular", "tabular*",
+    "thebibliography", "titlepage", "trivlist", "verbatim", "verbatim*", "verse",
+    # amsmath
+    "align", "align*", "alignat", "alignat*", "aligned", "alignedat", "Bmatrix",
+    "bmatrix", "cases", "equation*", "flalign", "flalign*", "gather", "gather*",
+    "gathered", "matrix", "multline", "multline*", "pmatrix", "smallmatrix", "split",
+    "subequations", "Vmatrix", "vmatrix",
+}
+
+TOKEN_PATTERN = re.compile(r"\\(?:[a-zA-Z@]+\*?|.)|[{}$%]", re.S)
+ENVIRONMENT_NAME_PATTERN = re.compile(r"\s*\{([^{}]*)\}")
+MATH_CLOSERS = {"$": "$", "$$": "$$", "\\[": "\\]", "\\(": "\\)"}
+# commands whose argument is text even inside math, so it can hold math of its own
+TEXT_COMMANDS = {
+    "\\text", "\\mbox", "\\hbox", "\\vbox", "\\fbox", "\\makebox", "\\framebox",
+    "\\intertext", "\\textrm", "\\textbf", "\\textit", "\\textsf", "\\texttt",
+    "\\textup", "\\textsl", "\\textsc", "\\textnormal",
+}
+# the optional arguments (e.g. of \makebox[2cm][l]) and the brace opening the text
+TEXT_ARGUMENT_PATTERN = re.compile(r"\s*(?:\[[^\]]*\]\s*)*\{")
+
+
+def is_truncated(response_data):
+    """True if the model stopped because it ran out of max_tokens."""
+    if not isinstance(response_data, dict):
+        return False
+    choices = response_data.get("choices") or [{}]
+    return choices[0].get("finish_reason") == "length"
+
+
+def validate_latex(text, known_environments=KNOWN_ENVIRONMENTS):
+    """
+    Check braces, \\begin/\\end pairs, math delimiters and environment names. Returns a
+    list of problems, empty if the text looks compilable.
+    """
+    line_starts = [0] + [match.end() for match in re.finditer("\n", text)]
+    source_lines = text.split("\n")
+
+    def problem(message, pos):
+        line = bisect.bisect_right(line_starts, pos)
+        return {
+            "message": message,
+            "line": line,
+            "context": source_lines[line - 1].strip()[:60],
+        }
+
+    problems = []
+    open_braces = []
+    open_environments = []
+    open_math = None  # (delimiter, position) of the math mode we are in
+    # (number of open braces inside the group, math mode outside it) of the text arguments
+    # we are in, since each of them starts again outside of math
+    text_groups = []
+    pos = 0
+    while True:
+        match = TOKEN_PATTERN.search(text, pos)
+        if match is None:
+            break
+        token = match.group()
+        pos = match.end()
+
+        if token == "%":
+            # comment, skip the rest of the line
+            newline = text.find("\n", pos)
+            pos = len(text) if newline == -1 else newline
+        elif token == "{":
+            open_braces.append(match.start())
+        elif token == "}":
+            if text_groups and text_groups[-1][0] == len(open_braces):
+                if open_math is not None:
+                    problems.append(
+                        problem(f"math opened with {open_math[0]} is never closed", open_math[1])
+                    )
+                open_math = text_groups.pop()[1]
+            if open_braces:
+                open_braces.pop()
+            else:
+                problems.append(problem("unmatched }", match.start()))
+        elif token in TEXT_COMMANDS:
+            argument_match = TEXT_ARGUMENT_PATTERN.match(text, pos)
+            if argument_match is not None:
+                pos = argument_match.end()
+                open_braces.append(pos - 1)
+                text_groups.append((len(open_braces), open_math))
+                open_math = None
+        elif token in ("\\begin", "\\end"):
+            name_match = ENVIRONMENT_NAME_PATTERN.match(text, pos)
+            if name_match is None:
+                problems.append(problem(f"{token} without an environment name", match.start()))
+                continue
+            pos = name_match.end()
+            name = name_match.group(1).strip()
+            if token == "\\begin":
+                if name not in known_environments:
+                    problems.append(
+                        problem(f"unknown environment {name} (package not loaded)", match.start())
+                    )
+                open_environments.append((name, match.start()))
+            elif not open_environments:
+                problems.append(problem(f"\\end{{{name}}} without a \\begin", match.start()))
+            elif open_environments[-1][0] != name:
+                opened_name, opened_pos = open_environments[-1]
+                problems.append(
+                    problem(
+                        f"\\end{{{name}}} closes \\begin{{{opened_name}}} from line "
+                        f"{bisect.bisect_right(line_starts, opened_pos)}",
+                        match.start(),
+                    )
+                )
+                # close up to the matching \begin if there is one, otherwise treat it
+                # as a misspelt \end of the innermost environment
+                if name in [opened for opened, _ in open_environments]:
+                    while open_environments.pop()[0] != name:
+                        pass
+                else:
+                    open_environments.pop()
+            else:
+                open_environments.pop()
+        elif token in ("$", "\\[", "\\(", "\\]", "\\)"):
+            if token == "$" and text.startswith("$", pos):
+                token = "$$"
+                pos += 1
+            if open_math is None:
+                if token in MATH_CLOSERS:
+                    open_math = (token, match.start())
+                else:
+                    problems.append(problem(f"{token} outside of math mode", match.start()))
+            elif token == MATH_CLOSERS[open_math[0]]:
+                open_math = None
+            else:
+                problems.append(
+                    problem(f"{token} inside math opened with {open_math[0]}", match.start())
+                )
+
+    if open_math is not None:
+        problems.append(problem(f"math opened with {open_math[0]} is never closed", open_math[1]))
+    for name, start in open_environments:
+        problems.append(problem(f"\\begin{{{name}}} is never closed", start))
+    for start in open_braces:
+        problems.append(problem("unclosed {", start))
+    return problems
@@ -0,0 +1,341 @@
+"""
+Local stand-in for the parts of the OpenAI api that this repo uses (chat completions,
+streamed or not, and the batch endpoints), so everything can be run without an api key
+or network access:
+
+    python3 mock_openai_server.py --port 8000 --latency 2 --rate-limit-rate 0.05
+
+and then set API_BASE_URL = "http://127.0.0.1:8000/v1" in gpt4_to_tex.py. Chat completions
+can be slowed down and made to fail with 500s or 429s, to see how the pipeline copes.
+"""
+import json
+import time
+import uuid
+import random
+import email
+import argparse
+import threading
+from email import policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_LATEX = (
+    "\\section*{Problem 1}\n"
+    "The partition function is $Z = \\sum_i e^{-\\beta E_i}$, so\n"
+    "\\begin{equation}\n"
+    "    \\langle E \\rangle = -\\frac{\\partial \\ln Z}{\\partial \\beta}.\n"
+    "\\end{equation}\n"
+    "\\end{document}"
+)
+# the real model likes to chat after the document, which clients have to cut off
+CANNED_REPLY = CANNED_LATEX + "\n\nLet me know if you would like any changes!"
+STREAM_CHUNK_CHARS = 8
+
+
+def reply_for(body, reply=CANNED_REPLY):
+    """The reply, once per page marked with its page line if the request packs several."""
+    num_images = sum(
+        1
+        for message in body.get("messages", [])
+        if isinstance(message.get("content"), list)
+        for part in message["content"]
+        if part.get("type") == "image_url"
+    )
+    if num_images <= 1:
+        return reply
+    return "\n".join(f"%%% PAGE {page}\n{reply}" for page in range(1, num_images + 1))
+
+
+def canned_stream_chunks(body, reply=CANNED_REPLY):
+    """The same reply as canned_completion, as the chunks of a streamed response."""
+    completion_id = "chatcmpl-" + uuid.uuid4().hex
+    model = body.get("model", "gpt-4-turbo")
+    reply = reply_for(body, reply)
+    for start in range(0, len(reply), STREAM_CHUNK_CHARS):
+        yield {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": reply[start : start + STREAM_CHUNK_CHARS]},
+                    "finish_reason": None,
+                }
+            ],
+        }
+    yield {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+    }
+    if body.get("stream_options", {}).get("include_usage"):
+        yield {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [],
+            "usage": canned_completion(body)["usage"],
+        }
+
+
+def canned_completion(body, reply=CANNED_REPLY):
+    """A chat completions response in the same shape the real api returns."""
+    return {
+        "id": "chatcmpl-" + uuid.uuid4().hex,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4-turbo"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": reply_for(body, reply)},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 1000, "completion_tokens": 100, "total_tokens": 1100},
+    }
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real api
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        if self.path == "/v1/chat/completions":
+            self.chat_completion()
+        elif self.path == "/v1/files":
+            self.upload_file()
+        elif self.path == "/v1/batches":
+            self.create_batch()
+        else:
+            self.send_json({"error": {"message": f"unknown path {self.path}"}}, 404)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+            self.get_batch(parts[2])
+        elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+            self.get_file_content(parts[2])
+        else:
+            self.send_json({"error": {"message": f"unknown path {self.path}"}}, 404)
+
+    def chat_completion(self):
+        raw_body = self.read_body()
+        body = json.loads(raw_body)
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+            server.stats["bytes_received"] += len(raw_body)
+        time.sleep(max(0, random.gauss(server.latency, server.latency_jitter)))
+
+        roll = random.random()
+        if roll < server.rate_limit_rate:
+            with server.lock:
+                server.stats["rate_limited"] += 1
+            body_bytes = json.dumps(
+                {"error": {"message": "Rate limit reached", "type": "requests"}}
+            ).encode("utf-8")
+            self.send_response(429)
+            self.send_header("Retry-After", str(server.retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body_bytes)))
+            self.end_headers()
+            self.wfile.write(body_bytes)
+            return
+        if roll < server.rate_limit_rate + server.error_rate:
+            with server.lock:
+                server.stats["errors"] += 1
+            self.send_json({"error": {"message": "The server had an error"}}, 500)
+            return
+
+        if not body.get("stream"):
+            self.send_json(canned_completion(body, server.reply))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        # no Content-Length, so the end of the stream is marked by closing the connection
+        self.send_header("Connection", "close")
+        self.close_connection = True
+        self.end_headers()
+        try:
+            for chunk in canned_stream_chunks(body, server.reply):
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading early, e.g. at \end{document}
+            pass
+
+    def upload_file(self):
+        # parse the multipart upload with the email parser, since cgi is going away
+        message = email.message_from_bytes(
+            b"Content-Type: "
+            + self.headers["Content-Type"].encode("utf-8")
+            + b"\r\n\r\n"
+            + self.read_body(),
+            policy=policy.HTTP,
+        )
+        content = None
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                content = part.get_payload(decode=True)
+        if content is None:
+            self.send_json({"error": {"message": "no file in upload"}}, 400)
+            return
+        file_id = "file-" + uuid.uuid4().hex
+        with self.server.lock:
+            self.server.files[file_id] = content
+        self.send_json(
+            {"id": file_id, "object": "file", "bytes": len(content), "purpose": "batch"}
+        )
+
+    def create_batch(self):
+        request = json.loads(self.read_body())
+        with self.server.lock:
+            input_lines = self.server.files[request["input_file_id"]].splitlines()
+        output_lines = []
+        for line in input_lines:
+            if not line.strip():
+                continue
+            batch_request = json.loads(line)
+            result = {
+                "id": "batch_req_" + uuid.uuid4().hex,
+                "custom_id": batch_request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": canned_completion(batch_request["body"], self.server.reply),
+                },
+                "error": None,
+            }
+            output_lines.append(json.dumps(result))
+        output_file_id = "file-" + uuid.uuid4().hex
+        batch = {
+            "id": "batch_" + uuid.uuid4().hex,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "output_file_id": output_file_id,
+            "error_file_id": None,
+            # report in_progress on the first poll so clients exercise their wait loop
+            "status": "in_progress",
+            "request_counts": {
+                "total": len(output_lines),
+                "completed": len(output_lines),
+                "failed": 0,
+            },
+        }
+        with self.server.lock:
+            self.server.files[output_file_id] = "\n".join(output_lines).encode("utf-8")
+            self.server.batches[batch["id"]] = batch
+        self.send_json(batch)
+
+    def get_batch(self, batch_id):
+        with self.server.lock:
+            batch = self.server.batches.get(batch_id)
+            if batch is None:
+                self.send_json({"error": {"message": "no such batch"}}, 404)
+                return
+            response = dict(batch)
+            batch["status"] = "completed"
+        self.send_json(response)
+
+    def get_file_content(self, file_id):
+        with self.server.lock:
+            content = self.server.files.get(file_id)
+        if content is None:
+            self.send_json({"error": {"message": "no such file"}}, 404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/jsonl")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def make_server(
+    host="127.0.0.1",
+    port=0,
+    latency=0.0,
+    latency_jitter=0.0,
+    error_rate=0.0,
+    rate_limit_rate=0.0,
+    retry_after=1,
+    reply=CANNED_REPLY,
+):
+    """
+    latency and latency_jitter are the mean and standard deviation in seconds of how long
+    a chat completion takes. error_rate and rate_limit_rate are the fractions of chat
+    completions answered with a 500 or with a 429 (with a Retry-After of retry_after).
+    """
+    server = ThreadingHTTPServer((host, port), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.files = {}
+    server.batches = {}
+    server.latency = latency
+    server.latency_jitter = latency_jitter
+    server.error_rate = error_rate
+    server.rate_limit_rate = rate_limit_rate
+    server.retry_after = retry_after
+    server.reply = reply
+    server.stats = {"requests": 0, "bytes_received": 0, "rate_limited": 0, "errors": 0}
+    return server
+
+
+def start_in_background(host="127.0.0.1", port=0, **options):
+    """
+    Start the server on a daemon thread, with the options of make_server. Returns the
+    server and its API_BASE_URL.
+    """
+    server = make_server(host, port, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI api.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="std seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--reply-file", help="file with the reply to give instead")
+    args = parser.parse_args()
+    reply = CANNED_REPLY
+    if args.reply_file:
+        with open(args.reply_file, "r") as file:
+            reply = file.read()
+    server = make_server(
+        args.host,
+        args.port,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        reply=reply,
+    )
+    print(f"mock api listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
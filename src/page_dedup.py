@@ -0,0 +1,148 @@
+"""
+Drop retakes of the same page before they are sent to the api. Every photo gets a
+perceptual hash (the signs of the low frequencies of a 32x32 DCT, computed for all photos
+at once) and a sharpness score (the variance of its Laplacian). Runs of consecutive photos
+whose hashes are within MAX_HASH_DISTANCE bits of each other are treated as one page, and
+only the sharpest photo of the run is kept.
+
+Retakes are always taken right after each other, so only neighbours in page order are
+compared. That keeps two similar looking but different pages from being merged.
+"""
+import os
+
+# numpy and PIL are imported inside the functions, like in gpt4_to_tex
+
+HASH_SIZE = 8  # the hash is HASH_SIZE x HASH_SIZE bits
+DCT_SIZE = 32  # photos are shrunk to DCT_SIZE x DCT_SIZE before hashing
+MAX_HASH_DISTANCE = 10  # bits out of HASH_SIZE**2 that may differ between retakes
+SHARPNESS_EDGE = 1024  # long edge the sharpness is measured at
+
+# (path, size, mtime) -> (thumbnail, sharpness), so each photo is decoded once per run
+_features = {}
+_reported = set()
+
+
+def dct_matrix(size):
+    """The orthonormal DCT-II matrix, so the 2d DCT of x is D @ x @ D.T."""
+    import numpy as np
+
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def laplacian_variance(pixels):
+    """Variance of the 4-neighbour Laplacian of a 2d array. Blurry photos score low."""
+    laplacian = (
+        pixels[:-2, 1:-1]
+        + pixels[2:, 1:-1]
+        + pixels[1:-1, :-2]
+        + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+def image_features(image_path):
+    """Decode a photo once, returning its DCT_SIZE thumbnail and its sharpness."""
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    stat = os.stat(image_path)
+    key = (str(image_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _features:
+        with Image.open(image_path) as img:
+            # let the jpeg decoder skip the detail we don't need
+            img.draft("L", (SHARPNESS_EDGE, SHARPNESS_EDGE))
+            img = ImageOps.exif_transpose(img).convert("L")
+            img.thumbnail((SHARPNESS_EDGE, SHARPNESS_EDGE))
+            sharpness = laplacian_variance(np.asarray(img, dtype=np.float32))
+            thumbnail = np.asarray(
+                img.resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float32
+            )
+        _features[key] = (thumbnail, sharpness)
+    return _features[key]
+
+
+def perceptual_hashes(thumbnails):
+    """Hash bits of a stack of thumbnails, shape (photos, HASH_SIZE**2)."""
+    import numpy as np
+
+    matrix = dct_matrix(DCT_SIZE)
+    # the 2d DCT of every thumbnail in one go
+    dct = np.einsum("ij,njk,lk->nil", matrix, thumbnails, matrix)
+    low = dct[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbnails), -1)
+    # leave the overall brightness (the DC term) out of the median
+    return low > np.median(low[:, 1:], axis=1, keepdims=True)
+
+
+def find_duplicates(image_paths):
+    """
+    Group the photos (in page order) into runs of retakes. Returns the paths to keep and
+    a list of (dropped path, kept path, dropped sharpness, kept sharpness).
+    """
+    import numpy as np
+
+    if len(image_paths) < 2:
+        return list(image_paths), []
+    features = []
+    for path in image_paths:
+        try:
+            features.append(image_features(path))
+        except OSError as error:
+            # e.g. a truncated photo, which is kept as a page of its own and fails there
+            report_unreadable(path, error)
+            features.append(None)
+    readable = [idx for idx, feature in enumerate(features) if feature is not None]
+    hashes = {}
+    if readable:
+        stacked = perceptual_hashes(np.stack([features[idx][0] for idx in readable]))
+        hashes = dict(zip(readable, stacked))
+    sharpness = [feature[1] if feature is not None else 0 for feature in features]
+
+    runs = [[0]]
+    for idx in range(1, len(image_paths)):
+        if (
+            idx in hashes
+            and idx - 1 in hashes
+            # distance to the photo before it
+            and np.count_nonzero(hashes[idx] != hashes[idx - 1]) <= MAX_HASH_DISTANCE
+        ):
+            runs[-1].append(idx)
+        else:
+            runs.append([idx])
+
+    kept = []
+    dropped = []
+    for run in runs:
+        best = max(run, key=lambda idx: sharpness[idx])
+        kept.append(image_paths[best])
+        dropped += [
+            (image_paths[idx], image_paths[best], sharpness[idx], sharpness[best])
+            for idx in run
+            if idx != best
+        ]
+    return kept, dropped
+
+
+def report_unreadable(image_path, error):
+    """Print once that a photo couldn't be read, so it isn't compared with its neighbours."""
+    if (image_path, None) in _reported:
+        return
+    _reported.add((image_path, None))
+    print(f"can't check {os.path.basename(image_path)} for retakes: {error}")
+
+
+def report_duplicates(dropped):
+    """Print each dropped photo once, however often the folder is listed."""
+    for dropped_path, kept_path, dropped_sharpness, kept_sharpness in dropped:
+        if (dropped_path, kept_path) in _reported:
+            continue
+        _reported.add((dropped_path, kept_path))
+        print(
+            f"skipping {os.path.basename(dropped_path)}, a retake of "
+            f"{os.path.basename(kept_path)} (sharpness {dropped_sharpness:.0f} vs "
+            f"{kept_sharpness:.0f})"
+        )
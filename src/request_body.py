@@ -0,0 +1,84 @@
+"""
+JSON request bodies written out piece by piece. A page's base64 image is the bulk of every
+request, and json.dumps(payload).encode() would copy it twice more (into the JSON string
+and into its bytes). Here the payload is dumped without its long strings, which are then
+encoded BODY_CHUNK_BYTES at a time as the body is read, so the image is only ever held
+once, as the string in the payload. The bytes are the same as those of json.dumps.
+"""
+import re
+import json
+
+BODY_CHUNK_BYTES = 64 * 1024
+# strings json.dumps writes out unchanged: printable ascii without quotes or backslashes
+VERBATIM_STRING_PATTERN = re.compile(r'[ !#-\[\]-~]*')
+PLACEHOLDER_PATTERN = re.compile(r"@@long-string-(\d+)@@")
+
+
+def split_payload(payload, sort_keys=False):
+    """
+    The JSON of payload as the text around its long strings, and the long strings.
+    The JSON is parts[0] + long_strings[0] + parts[1] + ... + parts[-1].
+    """
+    long_strings = []
+
+    def strip(value):
+        if isinstance(value, dict):
+            return {key: strip(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [strip(item) for item in value]
+        if (
+            isinstance(value, str)
+            and len(value) > BODY_CHUNK_BYTES
+            and VERBATIM_STRING_PATTERN.fullmatch(value)
+        ):
+            long_strings.append(value)
+            return f"@@long-string-{len(long_strings) - 1}@@"
+        return value
+
+    skeleton = json.dumps(strip(payload), sort_keys=sort_keys)
+    # re.split puts the captured index between the text around each placeholder
+    pieces = PLACEHOLDER_PATTERN.split(skeleton)
+    return pieces[::2], [long_strings[int(index)] for index in pieces[1::2]]
+
+
+def json_chunks(payload, sort_keys=False):
+    """Yield the bytes of json.dumps(payload) in pieces of at most BODY_CHUNK_BYTES."""
+    return join_chunks(*split_payload(payload, sort_keys))
+
+
+def join_chunks(parts, long_strings):
+    for idx, part in enumerate(parts):
+        yield part.encode("ascii")
+        if idx < len(long_strings):
+            long_string = long_strings[idx]
+            for start in range(0, len(long_string), BODY_CHUNK_BYTES):
+                yield long_string[start : start + BODY_CHUNK_BYTES].encode("ascii")
+
+
+class StreamedJSONBody:
+    """
+    A file-like request body for requests' data=, which reads it block by block (with a
+    Content-Length from len()). Make a new one for every attempt, it can only be read once.
+    """
+
+    def __init__(self, payload):
+        parts, long_strings = split_payload(payload)
+        self.length = sum(len(part) for part in parts) + sum(map(len, long_strings))
+        self.chunks = join_chunks(parts, long_strings)
+        self.pending = b""
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.pending + b"".join(self.chunks)
+            self.pending = b""
+            return data
+        while len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
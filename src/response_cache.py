@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+import request_body
+
+CACHE_FOLDER = Path("../cache/responses")
+MAX_CACHE_BYTES = 500 * 1024 * 1024
+MAX_CACHE_AGE_DAYS = 90
+
+
+def cache_key(prompt_type, payload):
+    """
+    Hash everything that determines the answer: the encoded image, prompt type, system
+    prompt, preamble, model and max_tokens (all but prompt_type live in the payload).
+    """
+    hasher = hashlib.sha256()
+    hasher.update(prompt_type.encode("utf-8"))
+    # the same bytes as json.dumps(payload, sort_keys=True), without copying the image
+    for chunk in request_body.json_chunks(payload, sort_keys=True):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def cache_path(key, cache_folder=CACHE_FOLDER):
+    return Path(cache_folder) / key[:2] / (key + ".json")
+
+
+def load_cached_response(key, cache_folder=CACHE_FOLDER):
+    """Return the stored response_data for this key, or None if it isn't cached."""
+    path = cache_path(key, cache_folder)
+    try:
+        with open(path, "r") as file:
+            response_data = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    # touch the entry so eviction drops the least recently used responses first
+    os.utime(path)
+    return response_data
+
+
+def save_cached_response(key, response_data, cache_folder=CACHE_FOLDER):
+    path = cache_path(key, cache_folder)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write then rename, so a crash never leaves a half written entry behind
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(response_data, file)
+    os.replace(tmp_path, path)
+
+
+def delete_cached_response(key, cache_folder=CACHE_FOLDER):
+    try:
+        os.remove(cache_path(key, cache_folder))
+    except FileNotFoundError:
+        pass
+
+
+def evict_cache(
+    cache_folder=CACHE_FOLDER,
+    max_bytes=MAX_CACHE_BYTES,
+    max_age_days=MAX_CACHE_AGE_DAYS,
+):
+    """Delete entries older than max_age_days, then the oldest ones until under max_bytes."""
+    cache_folder = Path(cache_folder)
+    if not cache_folder.is_dir():
+        return 0
+    oldest_allowed = time.time() - max_age_days * 24 * 60 * 60
+    entries = []
+    removed = 0
+    for path in cache_folder.glob("*/*.json"):
+        stat = path.stat()
+        if stat.st_mtime < oldest_allowed:
+            path.unlink()
+            removed += 1
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        path.unlink()
+        total_bytes -= size
+        removed += 1
+    if removed:
+        print(f"evicted {removed} cached responses")
+    return removed
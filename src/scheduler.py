@@ -0,0 +1,347 @@
+"""
+Runs a whole cohort of pset folders as one queue of page jobs:
+
+    python3 scheduler.py --homework 3 --budget 5 --rpm 60 --tpm 80000 folder_a folder_b
+    python3 scheduler.py --resume
+
+Every unfinished page of every folder becomes a job. Jobs are sent by a pool of workers,
+earliest folder first (in the order given, or by name for "all"), so the first folders
+are finished and consolidated while later ones are still going. Requests are held back to
+stay under the requests and tokens per minute limits, and no job is started once the cost
+of the tokens used so far (from the usage of each response) plus the jobs in flight
+could go over the budget. The queue is saved after every job, so a run that was stopped
+(or ran out of budget) continues where it left off with --resume.
+"""
+import sys
+import json
+import time
+import heapq
+import argparse
+import threading
+import traceback
+import collections
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import gpt4_to_tex
+import job_manifest
+import tracing
+
+QUEUE_FILE_NAME = "scheduler_queue.json"
+REQUESTS_PER_MINUTE = 60
+TOKENS_PER_MINUTE = 80000
+BUDGET_DOLLARS = 5.0
+# prompt tokens of a page before any response has told us, a high detail image is ~1100
+INITIAL_PROMPT_TOKENS = 1500
+
+
+class RateLimiter:
+    """Sliding one minute window over the requests sent and the tokens they used."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = collections.deque()  # [start time, tokens] of recent requests
+        self.lock = threading.Lock()
+
+    def wait_time(self, tokens, now):
+        while self.window and now - self.window[0][0] >= 60:
+            self.window.popleft()
+        delay = 0
+        if len(self.window) >= self.requests_per_minute:
+            delay = 60 - (now - self.window[0][0])
+        excess = sum(used for _, used in self.window) + tokens - self.tokens_per_minute
+        for start, used in self.window:
+            if excess <= 0:
+                break
+            # wait for the oldest requests to leave the window until the new one fits
+            excess -= used
+            delay = max(delay, 60 - (now - start))
+        return delay
+
+    def acquire(self, tokens):
+        """
+        Block until a request of about `tokens` fits in the limits, then count it. Returns
+        its window entry, for settle to correct once the real usage is known.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.wait_time(tokens, now)
+                if delay <= 0:
+                    entry = [now, tokens]
+                    self.window.append(entry)
+                    return entry
+            time.sleep(delay)
+
+    def settle(self, entry, tokens):
+        with self.lock:
+            entry[1] = tokens
+
+
+def build_queue(folders, homework_number, budget):
+    """
+    A new queue with a job for every page of the folders that isn't done yet, the pages
+    of their scanned documents included.
+    """
+    jobs = []
+    for folder in folders:
+        manifest = job_manifest.manifest_for(gpt4_to_tex.RESULTS_FOLDER / folder)
+        for idx, image_name in enumerate(gpt4_to_tex.list_page_images(Path(folder))):
+            image_path = gpt4_to_tex.PSET_FOLDER / folder / image_name
+            if manifest.is_done(image_name, image_path):
+                continue
+            jobs.append(
+                {
+                    "folder": str(folder),
+                    "page_number": idx + 1,
+                    "image_name": image_name,
+                    "attempts": 0,
+                    "state": "queued",
+                }
+            )
+        document_hashes = {}
+        for (
+            document_path,
+            page_in_document,
+            page_number,
+            name,
+        ) in gpt4_to_tex.list_document_pages(Path(folder)):
+            if document_path not in document_hashes:
+                document_hashes[document_path] = job_manifest.hash_image_file(
+                    document_path
+                )
+            if manifest.is_done(name, image_hash=document_hashes[document_path]):
+                continue
+            jobs.append(
+                {
+                    "folder": str(folder),
+                    "page_number": page_number,
+                    "image_name": name,
+                    "document": document_path.name,
+                    "page_in_document": page_in_document,
+                    "document_hash": document_hashes[document_path],
+                    "attempts": 0,
+                    "state": "queued",
+                }
+            )
+    return {
+        "homework": homework_number,
+        "folders": [str(folder) for folder in folders],
+        "budget": budget,
+        "spent": {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0},
+        "consolidated": [],
+        "jobs": jobs,
+    }
+
+
+def load_queue(queue_path):
+    with open(queue_path, "r") as file:
+        return json.load(file)
+
+
+def save_queue(queue, queue_path):
+    tmp_path = queue_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(queue, file, indent=2)
+    tmp_path.replace(queue_path)
+
+
+def run_job(job, openai_api_key, homework_number):
+    """
+    Request and compile one page. Returns what handle_response said, the usage (empty if
+    the response didn't report it) and whether the response came from the cache.
+    """
+    selected_folder = Path(job["folder"])
+    if "document" in job:
+        response_data, latex_preamble = gpt4_to_tex.request_document_page(
+            job["page_number"],
+            gpt4_to_tex.PSET_FOLDER / selected_folder / job["document"],
+            job["page_in_document"],
+            job["image_name"],
+            selected_folder,
+            openai_api_key,
+            homework_number,
+            document_hash=job["document_hash"],
+            use_cache=job["attempts"] == 1,
+        )
+    else:
+        response_data, latex_preamble = gpt4_to_tex.request_page(
+            job["page_number"],
+            job["image_name"],
+            selected_folder,
+            openai_api_key,
+            homework_number,
+            use_cache=job["attempts"] == 1,
+        )
+    next_action = gpt4_to_tex.handle_response(
+        response_data,
+        job["image_name"],
+        job["page_number"],
+        latex_preamble,
+        selected_folder,
+        "single_image",
+        show_pdf=False,
+    )
+    if not isinstance(response_data, dict):
+        return next_action, {}, False
+    cached = (response_data.get("cache") or {}).get("hit", False)
+    return next_action, response_data.get("usage") or {}, cached
+
+
+def run_queue(queue, queue_path, openai_api_key, workers, limiter):
+    """
+    Work through the queued jobs. Returns True if every job finished, False if some
+    failed or were left for later because of the budget.
+    """
+    spent = queue["spent"]
+    jobs = queue["jobs"]
+    folder_order = {folder: idx for idx, folder in enumerate(queue["folders"])}
+    heap = [
+        (folder_order[job["folder"]], job["page_number"], idx)
+        for idx, job in enumerate(jobs)
+        if job["state"] == "queued"
+    ]
+    heapq.heapify(heap)
+
+    def average_prompt_tokens():
+        if spent["requests"] == 0:
+            return INITIAL_PROMPT_TOKENS
+        return spent["prompt_tokens"] / spent["requests"]
+
+    def consolidate_finished_folders():
+        for folder in queue["folders"]:
+            if folder in queue["consolidated"] or any(
+                job["folder"] == folder and job["state"] == "queued" for job in jobs
+            ):
+                continue
+            gpt4_to_tex.consolidate_tex_files_sorted(
+                gpt4_to_tex.RESULTS_FOLDER / folder, queue["homework"]
+            )
+            queue["consolidated"].append(folder)
+            save_queue(queue, queue_path)
+
+    gpt4_to_tex.reserve_connections(workers)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while heap or in_flight:
+            over_budget = None
+            while heap and len(in_flight) < workers:
+                prompt_tokens = average_prompt_tokens()
+                # the worst case, since the whole of max_tokens can be used
+                estimate = tracing.estimated_cost(prompt_tokens, gpt4_to_tex.MAX_TOKENS)
+                committed = tracing.estimated_cost(
+                    spent["prompt_tokens"], spent["completion_tokens"]
+                ) + sum(cost for _, _, cost, _ in in_flight.values())
+                if committed + estimate > queue["budget"]:
+                    # pages in flight usually cost far less than their worst case, so
+                    # look again once they are done
+                    over_budget = committed
+                    break
+                _, _, idx = heapq.heappop(heap)
+                job = jobs[idx]
+                job["attempts"] += 1
+                # the api counts max_tokens against the tokens per minute up front
+                entry = limiter.acquire(prompt_tokens + gpt4_to_tex.MAX_TOKENS)
+                future = executor.submit(run_job, job, openai_api_key, queue["homework"])
+                in_flight[future] = (idx, entry, estimate, prompt_tokens)
+            if not in_flight:
+                if over_budget is not None:
+                    print(
+                        f"stopping: ${over_budget:.2f} spent, another page could go over "
+                        f"the ${queue['budget']:.2f} budget"
+                    )
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx, entry, _, prompt_tokens = in_flight.pop(future)
+                job = jobs[idx]
+                try:
+                    next_action, usage, cached = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    next_action, usage, cached = "try_again", {}, False
+                if cached:
+                    # no request went out, so nothing was spent
+                    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+                elif not usage:
+                    # e.g. a streamed reply cut off before its usage chunk, so assume
+                    # the worst rather than let the budget go unchecked
+                    usage = {
+                        "prompt_tokens": round(prompt_tokens),
+                        "completion_tokens": gpt4_to_tex.MAX_TOKENS,
+                    }
+                used = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+                limiter.settle(entry, used)
+                if not cached:
+                    spent["requests"] += 1
+                    spent["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                    spent["completion_tokens"] += usage.get("completion_tokens", 0)
+                if next_action == "continue":
+                    job["state"] = "done"
+                elif job["attempts"] < gpt4_to_tex.MAX_ATTEMPTS_PER_PAGE:
+                    heapq.heappush(
+                        heap, (folder_order[job["folder"]], job["page_number"], idx)
+                    )
+                else:
+                    print(f"giving up on {job['folder']}/{job['image_name']}")
+                    job["state"] = "failed"
+                save_queue(queue, queue_path)
+            consolidate_finished_folders()
+    consolidate_finished_folders()
+
+    cost = tracing.estimated_cost(spent["prompt_tokens"], spent["completion_tokens"])
+    counts = collections.Counter(job["state"] for job in jobs)
+    print(
+        f"{counts['done']} pages done, {counts['failed']} failed, {counts['queued']} "
+        f"left in the queue. ${cost:.2f} of the ${queue['budget']:.2f} budget used."
+    )
+    return counts["done"] == len(jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many pset folders as one queue.")
+    parser.add_argument("folders", nargs="*", help='folders in priority order, or "all"')
+    parser.add_argument("--homework", type=int)
+    parser.add_argument("--resume", action="store_true", help="continue the saved queue")
+    parser.add_argument(
+        "--budget", type=float, help=f"dollars (default {BUDGET_DOLLARS})"
+    )
+    parser.add_argument("--rpm", type=int, default=REQUESTS_PER_MINUTE)
+    parser.add_argument("--tpm", type=int, default=TOKENS_PER_MINUTE)
+    parser.add_argument(
+        "--workers", type=int, default=gpt4_to_tex.MAX_CONCURRENT_REQUESTS
+    )
+    args = parser.parse_args()
+    if args.resume == bool(args.folders):
+        parser.error("give either folders (with --homework) or --resume")
+    if args.folders and args.homework is None:
+        parser.error("--homework is required when folders are given")
+
+    gpt4_to_tex.SHOW_COMPILED_PDF = False
+    gpt4_to_tex.SHOW_PAGE_IMAGE = False
+    gpt4_to_tex.RESULTS_FOLDER.mkdir(parents=True, exist_ok=True)
+    queue_path = gpt4_to_tex.RESULTS_FOLDER / QUEUE_FILE_NAME
+    if args.resume:
+        queue = load_queue(queue_path)
+        if args.budget is not None:
+            queue["budget"] = args.budget
+    else:
+        folders = args.folders
+        if folders == ["all"]:
+            folders = sorted(gpt4_to_tex.list_subfolders(gpt4_to_tex.PSET_FOLDER))
+        budget = BUDGET_DOLLARS if args.budget is None else args.budget
+        queue = build_queue(folders, args.homework, budget)
+    save_queue(queue, queue_path)
+
+    openai_api_key = gpt4_to_tex.load_parameters()["openai_api_key"]
+    tracing.start_trace(gpt4_to_tex.RESULTS_FOLDER / gpt4_to_tex.TRACE_FILE_NAME)
+    finished = run_queue(
+        queue, queue_path, openai_api_key, args.workers, RateLimiter(args.rpm, args.tpm)
+    )
+    tracing.print_summary()
+    sys.exit(0 if finished else 1)
+
+
+if __name__ == "__main__":
+    main()
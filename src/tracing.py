@@ -0,0 +1,139 @@
+"""
+Per stage timing and cost instrumentation. Each stage of each page (encode, request,
+compile, ...) is recorded as a span with its wall time, bytes in and out, token usage and
+retries. Spans are appended to a jsonl trace file and summarised at the end of a run.
+"""
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# gpt-4-turbo prices in dollars, update these if the model changes
+PRICE_PER_1K_PROMPT_TOKENS = 0.01
+PRICE_PER_1K_COMPLETION_TOKENS = 0.03
+
+_lock = threading.Lock()
+_local = threading.local()
+_spans = []
+_trace_file = None
+
+
+def start_trace(trace_path):
+    """Start a new run, appending its spans to trace_path."""
+    global _trace_file
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _spans.clear()
+        trace_path.parent.mkdir(parents=True, exist_ok=True)
+        _trace_file = open(trace_path, "a")
+
+
+@contextmanager
+def current_page(page):
+    """Attribute the spans recorded by this thread inside the block to a page."""
+    previous = getattr(_local, "page", None)
+    _local.page = page
+    try:
+        yield
+    finally:
+        _local.page = previous
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Time a stage. Yields the span's record, so the block can fill in bytes_in, bytes_out,
+    prompt_tokens, completion_tokens etc.
+    """
+    record = {"stage": stage, "page": getattr(_local, "page", None), "retries": 0}
+    record.update(fields)
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(record)
+    record["start"] = time.time()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            _spans.append(record)
+            if _trace_file is not None:
+                _trace_file.write(json.dumps(record, default=str) + "\n")
+                _trace_file.flush()
+
+
+def count_retry():
+    """Count a retry against the innermost span open on this thread."""
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1]["retries"] += 1
+
+
+def record_usage(record, response_data):
+    """Copy the token counts of a chat completions response into a span."""
+    usage = (response_data or {}).get("usage") or {}
+    record["prompt_tokens"] = usage.get("prompt_tokens", 0)
+    record["completion_tokens"] = usage.get("completion_tokens", 0)
+
+
+def estimated_cost(prompt_tokens, completion_tokens):
+    return (
+        prompt_tokens / 1000 * PRICE_PER_1K_PROMPT_TOKENS
+        + completion_tokens / 1000 * PRICE_PER_1K_COMPLETION_TOKENS
+    )
+
+
+def summarize():
+    """Totals per stage over the spans of the current run."""
+    with _lock:
+        spans = list(_spans)
+    stages = {}
+    for record in spans:
+        totals = stages.setdefault(
+            record["stage"],
+            {
+                "count": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "retries": 0,
+            },
+        )
+        totals["count"] += 1
+        totals["seconds"] += record["seconds"]
+        totals["max_seconds"] = max(totals["max_seconds"], record["seconds"])
+        for key in ("bytes_in", "bytes_out", "prompt_tokens", "completion_tokens", "retries"):
+            totals[key] += record.get(key) or 0
+    return stages
+
+
+def print_summary():
+    stages = summarize()
+    if not stages:
+        return
+    print("")
+    print(
+        f"{'stage':<12} {'count':>6} {'total s':>8} {'mean s':>7} {'max s':>7} "
+        f"{'MB in':>7} {'MB out':>7} {'prompt tok':>10} {'compl tok':>9} {'retries':>7}"
+    )
+    prompt_tokens = 0
+    completion_tokens = 0
+    for stage, totals in stages.items():
+        print(
+            f"{stage:<12} {totals['count']:>6} {totals['seconds']:>8.2f} "
+            f"{totals['seconds'] / totals['count']:>7.2f} {totals['max_seconds']:>7.2f} "
+            f"{totals['bytes_in'] / 1e6:>7.2f} {totals['bytes_out'] / 1e6:>7.2f} "
+            f"{totals['prompt_tokens']:>10} {totals['completion_tokens']:>9} "
+            f"{totals['retries']:>7}"
+        )
+        prompt_tokens += totals["prompt_tokens"]
+        completion_tokens += totals["completion_tokens"]
+    print(
+        f"estimated cost: ${estimated_cost(prompt_tokens, completion_tokens):.2f} "
+        f"({prompt_tokens} prompt + {completion_tokens} completion tokens)"
+    )
@@ -0,0 +1,257 @@
+"""
+Long running mode which OCRs pages as soon as their photos land in the psets folder:
+
+    python3 watch_folder.py --homework 3
+
+New or changed page photos (or scanned documents) in any subfolder of PSET_FOLDER are
+noticed with inotify (or by polling every POLL_SECONDS where inotify isn't available),
+left alone until they stop changing for DEBOUNCE_SECONDS (photo sync tools write files in
+several goes), and then their folder is queued. A worker sends the folder's unfinished pages, compiles them, and
+rebuilds that folder's consolidated output only. Pages already done according to the
+manifest are skipped, so a new photo costs one api round trip.
+"""
+import os
+import sys
+import time
+import queue
+import ctypes
+import select
+import struct
+import argparse
+import threading
+import traceback
+import ctypes.util
+from pathlib import Path
+import gpt4_to_tex
+import document_input
+import tracing
+
+DEBOUNCE_SECONDS = 2.0
+POLL_SECONDS = 2.0
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class InotifyWatcher:
+    """Reports files created or written in root and its direct subfolders (Linux only)."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("no inotify on this system")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        self.add_watch(self.root)
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                self.add_watch(Path(entry.path))
+
+    def add_watch(self, folder):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"can't watch {folder}")
+        self.folders[wd] = folder
+
+    def changed_paths(self, timeout):
+        """Wait up to timeout seconds and return the paths that were touched meanwhile."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            folder = self.folders.get(wd)
+            if folder is None or not name:
+                continue
+            path = folder / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if folder == self.root:
+                    # a new pset folder, which may have arrived with its photos already in it
+                    self.add_watch(path)
+                    paths += [Path(entry.path) for entry in os.scandir(path)]
+                continue
+            paths.append(path)
+        return paths
+
+
+class PollingWatcher:
+    """The same interface as InotifyWatcher, by comparing directory listings."""
+
+    def __init__(self, root, interval=POLL_SECONDS):
+        self.root = Path(root)
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for folder in os.scandir(self.root):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.is_file():
+                    stat = entry.stat()
+                    snapshot[Path(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def changed_paths(self, timeout):
+        time.sleep(max(timeout, self.interval))
+        snapshot = self.scan()
+        changed = [
+            path for path, key in snapshot.items() if self.snapshot.get(path) != key
+        ]
+        self.snapshot = snapshot
+        return changed
+
+
+def make_watcher(root, force_polling=False):
+    if not force_polling:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError, TypeError) as e:
+            print(f"inotify not available ({e}), polling every {POLL_SECONDS}s instead")
+    return PollingWatcher(root)
+
+
+class Debouncer:
+    """Holds touched files back until their size and mtime stop changing."""
+
+    def __init__(self, quiet_seconds=DEBOUNCE_SECONDS):
+        self.quiet_seconds = quiet_seconds
+        self.pending = {}  # path -> ((size, mtime), time it last changed)
+
+    def touch(self, path):
+        self.pending[path] = (None, time.monotonic())
+
+    def ready_paths(self):
+        now = time.monotonic()
+        ready = []
+        for path, (key, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # deleted, or renamed by the sync tool (the new name gets its own event)
+                del self.pending[path]
+                continue
+            new_key = (stat.st_size, stat.st_mtime_ns)
+            if new_key != key:
+                self.pending[path] = (new_key, now)
+            elif now - since >= self.quiet_seconds:
+                del self.pending[path]
+                ready.append(path)
+        return ready
+
+
+def is_page_input(path):
+    """A page photo or a scanned document directly inside a pset folder."""
+    return path.parent.parent == gpt4_to_tex.PSET_FOLDER and (
+        gpt4_to_tex.PAGE_IMAGE_PATTERN.match(path.name) is not None
+        or path.suffix.lower() in document_input.DOCUMENT_EXTENSIONS
+    )
+
+
+def process_folder(selected_folder, openai_api_key, homework_number, concurrency):
+    """Send the unfinished pages of one folder and rebuild its consolidated output."""
+    results_folder = gpt4_to_tex.RESULTS_FOLDER / selected_folder
+    results_folder.mkdir(parents=True, exist_ok=True)
+    tracing.start_trace(results_folder / gpt4_to_tex.TRACE_FILE_NAME)
+    failed = gpt4_to_tex.process_images_concurrently(
+        selected_folder, openai_api_key, homework_number, concurrency
+    )
+    for image_name in failed:
+        print(f"failed: {selected_folder}/{image_name}")
+    gpt4_to_tex.consolidate_tex_files_sorted(results_folder, homework_number)
+    tracing.print_summary()
+
+
+def worker(folder_queue, queued, lock, openai_api_key, homework_number, concurrency):
+    while True:
+        selected_folder = folder_queue.get()
+        with lock:
+            # photos arriving from now on queue the folder again
+            queued.discard(selected_folder)
+        try:
+            process_folder(selected_folder, openai_api_key, homework_number, concurrency)
+        except Exception:
+            # keep watching, the next photo will retry the folder
+            traceback.print_exc()
+        print(f"watching {gpt4_to_tex.PSET_FOLDER} for new photos...")
+
+
+def watch(homework_number, concurrency, force_polling=False, process_existing=False):
+    gpt4_to_tex.SHOW_COMPILED_PDF = False
+    gpt4_to_tex.SHOW_PAGE_IMAGE = False
+    openai_api_key = gpt4_to_tex.load_parameters()["openai_api_key"]
+
+    folder_queue = queue.Queue()
+    queued = set()
+    lock = threading.Lock()
+
+    def enqueue(selected_folder):
+        with lock:
+            if selected_folder in queued:
+                return
+            queued.add(selected_folder)
+        folder_queue.put(selected_folder)
+
+    threading.Thread(
+        target=worker,
+        args=(folder_queue, queued, lock, openai_api_key, homework_number, concurrency),
+        daemon=True,
+    ).start()
+
+    watcher = make_watcher(gpt4_to_tex.PSET_FOLDER, force_polling)
+    if process_existing:
+        for selected_folder in sorted(gpt4_to_tex.list_subfolders(gpt4_to_tex.PSET_FOLDER)):
+            enqueue(Path(selected_folder))
+    debouncer = Debouncer()
+    print(f"watching {gpt4_to_tex.PSET_FOLDER} for new photos...")
+    while True:
+        timeout = DEBOUNCE_SECONDS / 2 if debouncer.pending else 1.0
+        for path in watcher.changed_paths(timeout):
+            if is_page_input(path):
+                debouncer.touch(path)
+        for path in debouncer.ready_paths():
+            print(f"new input {path.parent.name}/{path.name}")
+            enqueue(Path(path.parent.name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR pages as their photos arrive.")
+    parser.add_argument("--homework", type=int, required=True)
+    parser.add_argument(
+        "--concurrency", type=int, default=gpt4_to_tex.MAX_CONCURRENT_REQUESTS
+    )
+    parser.add_argument("--poll", action="store_true", help="poll instead of inotify")
+    parser.add_argument(
+        "--process-existing",
+        action="store_true",
+        help="also do the unfinished pages already in the folders",
+    )
+    args = parser.parse_args()
+    gpt4_to_tex.RESULTS_FOLDER.mkdir(parents=True, exist_ok=True)
+    try:
+        watch(args.homework, args.concurrency, args.poll, args.process_existing)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
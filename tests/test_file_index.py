@@ -0,0 +1,83 @@
+import sys
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import file_index
+
+
+class ParsePageNameTest(unittest.TestCase):
+    def test_photo_and_output(self):
+        self.assertEqual(
+            file_index.parse_page_name("signal-2024-05-07-123456_002.JPEG"),
+            (False, (20240507123456, 2, ".jpeg")),
+        )
+        self.assertEqual(
+            file_index.parse_page_name("output_signal-2024-05-07-123456.tex"),
+            (True, (20240507123456, 0, ".tex")),
+        )
+
+    def test_not_page_files(self):
+        for name in (
+            "notes.txt",
+            "signal-2024-05-07-123456.tex",
+            "output_signal-2024-05-07-123456.png",
+            "signal-2024-05-07-12345.jpg",
+            "consolidated_output.tex",
+        ):
+            self.assertIsNone(file_index.parse_page_name(name), name)
+
+    def test_order_across_dates(self):
+        names = [
+            "signal-2024-05-08-000001.jpg",
+            "signal-2024-05-07-235959_002.jpg",
+            "signal-2023-12-31-235959.png",
+            "signal-2024-05-07-235959_001.jpg",
+            "signal-2024-05-07-235959.jpg",
+        ]
+        ordered = sorted(names, key=lambda name: file_index.parse_page_name(name)[1])
+        self.assertEqual(
+            ordered,
+            [
+                "signal-2023-12-31-235959.png",
+                "signal-2024-05-07-235959.jpg",
+                "signal-2024-05-07-235959_001.jpg",
+                "signal-2024-05-07-235959_002.jpg",
+                "signal-2024-05-08-000001.jpg",
+            ],
+        )
+
+
+class FolderListingTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_photos_and_outputs_in_the_same_order(self):
+        for name in (
+            "signal-2024-05-08-090000.jpg",
+            "signal-2024-05-07-180000.jpg",
+            "output_signal-2024-05-08-090000.tex",
+            "output_signal-2024-05-07-180000.tex",
+            "notes.txt",
+        ):
+            (self.folder / name).write_text("")
+        self.assertEqual(
+            file_index.page_images(self.folder),
+            ["signal-2024-05-07-180000.jpg", "signal-2024-05-08-090000.jpg"],
+        )
+        self.assertEqual(
+            file_index.page_tex_files(self.folder),
+            [
+                "output_signal-2024-05-07-180000.tex",
+                "output_signal-2024-05-08-090000.tex",
+            ],
+        )
+        self.assertIn("notes.txt", file_index.file_names(self.folder))
+
+
+if __name__ == "__main__":
+    unittest.main()
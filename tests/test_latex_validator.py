@@ -0,0 +1,36 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import latex_validator
+
+
+def messages(text):
+    return [problem["message"] for problem in latex_validator.validate_latex(text)]
+
+
+class TextInsideMathTest(unittest.TestCase):
+    def test_math_inside_text_inside_display_math(self):
+        self.assertEqual(messages(r"\[ \fbox{$x=3$} \]"), [])
+        self.assertEqual(messages(r"\[ x \text{ if $y>0$} \]"), [])
+        self.assertEqual(messages(r"\[ \makebox[2cm][l]{$z$} \]"), [])
+
+    def test_boxed_answer_inside_inline_math(self):
+        self.assertEqual(messages(r"$a = \hbox{$b$}$"), [])
+
+    def test_math_is_restored_after_the_text(self):
+        self.assertEqual(messages(r"\[ \text{a} $ \]"), ["$ inside math opened with \\["])
+
+    def test_math_left_open_inside_text(self):
+        self.assertEqual(
+            messages(r"\[ \text{$x} \]"), ["math opened with $ is never closed"]
+        )
+
+    def test_unclosed_math_is_still_found(self):
+        self.assertEqual(messages(r"$x = 1"), ["math opened with $ is never closed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
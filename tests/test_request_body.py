@@ -0,0 +1,85 @@
+import sys
+import json
+import base64
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import request_body
+
+
+def payload_with(image_url):
+    return {
+        "model": "gpt-4-turbo",
+        "messages": [
+            {
+                "role": "system",
+                "content": [{"type": "text", "text": "a \"quoted\"\nprompt"}],
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "\\section{Probl\u00e8me} \u2264 \u03c0"},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ],
+            },
+        ],
+        "max_tokens": 1024,
+    }
+
+
+def long_image_url(num_bytes):
+    encoded = base64.b64encode(bytes(range(256)) * (num_bytes // 256 + 1))
+    return "data:image/jpeg;base64," + encoded.decode("ascii")
+
+
+class StreamedBodyTest(unittest.TestCase):
+    def assert_same_as_dumps(self, payload):
+        expected = json.dumps(payload).encode("ascii")
+        self.assertEqual(b"".join(request_body.json_chunks(payload)), expected)
+        body = request_body.StreamedJSONBody(payload)
+        self.assertEqual(len(body), len(expected))
+        self.assertEqual(body.read(), expected)
+
+    def test_short_strings(self):
+        self.assert_same_as_dumps(payload_with("data:image/png;base64,AAAA"))
+
+    def test_long_image_string(self):
+        self.assert_same_as_dumps(
+            payload_with(long_image_url(3 * request_body.BODY_CHUNK_BYTES + 17))
+        )
+
+    def test_long_string_that_needs_escaping(self):
+        # json.dumps escapes these, so they have to stay in the dumped skeleton
+        self.assert_same_as_dumps(
+            payload_with("\u00e9\"\n" * request_body.BODY_CHUNK_BYTES)
+        )
+
+    def test_chunks_are_bounded(self):
+        payload = payload_with(long_image_url(2 * request_body.BODY_CHUNK_BYTES))
+        for chunk in request_body.json_chunks(payload):
+            self.assertLessEqual(len(chunk), request_body.BODY_CHUNK_BYTES)
+
+    def test_sort_keys(self):
+        payload = payload_with(long_image_url(request_body.BODY_CHUNK_BYTES + 1))
+        self.assertEqual(
+            b"".join(request_body.json_chunks(payload, sort_keys=True)),
+            json.dumps(payload, sort_keys=True).encode("ascii"),
+        )
+
+    def test_read_in_blocks(self):
+        payload = payload_with(long_image_url(2 * request_body.BODY_CHUNK_BYTES))
+        body = request_body.StreamedJSONBody(payload)
+        blocks = []
+        while True:
+            block = body.read(8192)
+            if not block:
+                break
+            self.assertLessEqual(len(block), 8192)
+            blocks.append(block)
+        self.assertEqual(b"".join(blocks), json.dumps(payload).encode("ascii"))
+
+
+if __name__ == "__main__":
+    unittest.main()
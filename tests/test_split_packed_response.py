@@ -0,0 +1,64 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import gpt4_to_tex
+
+
+def reply(content, finish_reason="stop"):
+    return {
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }
+        ]
+    }
+
+
+def contents(page_responses):
+    return [page["choices"][0]["message"]["content"] for page in page_responses]
+
+
+def finish_reasons(page_responses):
+    return [page["choices"][0]["finish_reason"] for page in page_responses]
+
+
+def split(content, num_pages, finish_reason="stop"):
+    return gpt4_to_tex.split_packed_response(reply(content, finish_reason), num_pages)
+
+
+class SplitPackedResponseTest(unittest.TestCase):
+    def test_pages_in_order(self):
+        pages = split("%%% PAGE 1\nfirst\n%%% PAGE 2 (continued)\nsecond\n", 2)
+        self.assertEqual(contents(pages), ["\nfirst\n", "\nsecond\n"])
+        self.assertEqual(finish_reasons(pages), ["stop", "stop"])
+
+    def test_text_before_the_first_marker_is_dropped(self):
+        pages = split("Sure!\n%%% PAGE 1\nonly\n", 1)
+        self.assertEqual(contents(pages), ["\nonly\n"])
+
+    def test_misnumbered_pages(self):
+        self.assertIsNone(split("%%% PAGE 1\na\n%%% PAGE 3\nb\n", 2))
+        self.assertIsNone(split("%%% PAGE 2\na\n%%% PAGE 1\nb\n", 2))
+
+    def test_missing_page(self):
+        self.assertIsNone(split("%%% PAGE 1\na\n", 2))
+
+    def test_truncated_reply_only_cuts_off_the_last_page(self):
+        pages = split("%%% PAGE 1\na\n%%% PAGE 2\n\\section{b", 2, "length")
+        self.assertEqual(finish_reasons(pages), ["stop", "length"])
+
+    def test_truncated_before_the_last_marker(self):
+        self.assertIsNone(split("%%% PAGE 1\na\n%%% PAGE 2\nb", 3, "length"))
+
+    def test_no_reply(self):
+        self.assertIsNone(gpt4_to_tex.split_packed_response(None, 2))
+        self.assertIsNone(gpt4_to_tex.split_packed_response({"choices": []}, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()